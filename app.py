@@ -1,21 +1,49 @@
 import uuid
 import os
 import sys
-import zipfile
-import urllib.request
-import gzip
-from io import BytesIO
-import time
+import shutil
+import hashlib
+import json
+import collections
+import contextlib
+import fcntl
+import itertools
+import threading
+import concurrent.futures
 import math
+import multiprocessing
+import time
+
+import numpy as np
 
 from flask import Flask
 from flask import render_template
 from flask import request
+from flask import url_for
+from flask import Response
+from flask import stream_with_context
+from flask import jsonify
+from flask import send_file
+from flask import abort
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
 
-from terrain_gen import add_offset
+from terrain_gen import (
+    longitude_scale, IO_BLOCK_SIZE, LOCATION_SCALING_FACTOR, LOCATION_SCALING_FACTOR_INV,
+    TERRAIN_GRID_BLOCK_SIZE_X, TERRAIN_GRID_BLOCK_SIZE_Y,
+)
+from terrain_zip import (
+    ZipWriter, GzipMember, read_gzip_member, read_central_directory, central_directory_entries, zip_size,
+)
+from tile_fetch import TileFetcher
+import sweeper
+import terrain_query
+import fast_gen
+from metrics import Metrics, SIZE_BUCKETS
+from dat_cache import DatCache
+from tile_catalog import TileCatalog, tile_position
 
 # Directory of this file
 this_path = os.path.dirname(os.path.realpath(__file__))
@@ -30,16 +58,203 @@ if "pytest" in sys.modules:
     url_path1 = 'https://terrain.ardupilot.org/tilesdat1/'
     tile_path3 = os.path.join(this_path, '..', 'tilesdat3')
     url_path3 = 'https://terrain.ardupilot.org/tilesdat3/'
+    tile_path6 = os.path.join(this_path, '..', 'tilesdat6')
+    tile_path9 = os.path.join(this_path, '..', 'tilesdat9')
 else:
     tile_path3 = os.path.join('/mnt/terrain_data/data/tilesdat3')
     tile_path1 = os.path.join('/mnt/terrain_data/data/tilesdat1')
+    tile_path6 = os.path.join('/mnt/terrain_data/data/tilesdat6')
+    tile_path9 = os.path.join('/mnt/terrain_data/data/tilesdat9')
     url_path1 = None
     url_path3 = None
+# the coarser databases, generated with fast_gen.py --also, aren't on the terrain server
+url_path6 = None
+url_path9 = None
+
+# Grid spacing (m) of each terrain version: SRTM1, SRTM3, and coarser
+# databases for very large requests
+spacings = {1: 30, 3: 100, 6: 200, 9: 300}
+
+# Where the HGT data is, for generating tiles missing from tile_path1/3/6/9
+# on demand. None to only serve pregenerated tiles
+hgt_path1 = None
+hgt_path3 = None
+hgt_path6 = None
+hgt_path9 = None
+
+# Where state shared between the app processes is kept
+work_path = os.path.join(this_path, '..', 'terrainWork')
+
+# Where the status of background generation jobs is kept
+job_path = os.path.join(work_path, 'jobs')
+
+# Requests of at least this many tiles, about as many as a 100km radius
+# covers, are generated by a background job, so they don't hold up a web
+# worker. None to always generate immediately.
+if "pytest" in sys.modules:
+    async_tiles = None
+else:
+    async_tiles = 9
+
+# Seconds between each app process marking the jobs it is running as alive,
+# and after which a job which hasn't been, such as one lost when its app
+# process was restarted, is reported as failed
+job_heartbeat = 10
+job_stale = 60
+
+# Where each app process saves its metrics, for /metrics to report the
+# totals, and the seconds between saves
+metrics_path = os.path.join(work_path, 'metrics')
+metrics_interval = 10
+
+# Where the locks on building each bundle are kept
+lock_path = os.path.join(work_path, 'locks')
+
+# Where decompressed tiles are cached, shared by the app processes, and the
+# most space the cache may take
+dat_cache_path = os.path.join(work_path, 'datcache')
+dat_cache_bytes = 2 * 1024 * 1024 * 1024
+
+# Index of generated files, for expiring job status files and locks after
+# 24H and limiting the size of the bundles
+index_path = os.path.join(work_path, 'index.sqlite')
+
+# Most bytes of bundles kept under output_path. Beyond this the least
+# recently downloaded are removed, once they are store_min_age seconds old
+store_quota = 50 * 1024 * 1024 * 1024
+store_min_age = 60 * 60
+
+# Seconds between each app process sweeping expired files, or None if
+# sweeper.py is run separately instead
+if "pytest" in sys.modules:
+    sweep_interval = None
+else:
+    sweep_interval = 600
+
+# Seconds between checks of the tile folders for tiles changed by other
+# processes, to refresh each app process's catalog of the tiles they hold
+catalog_interval = 10
+
+# Whether the catalogs are built as the app starts, rather than by the first
+# requests needing them. Under uwsgi this is before the app processes are
+# forked, so they start with the master's catalogs
+if "pytest" in sys.modules:
+    catalog_at_start = False
+else:
+    catalog_at_start = True
+
+# Number of background generation jobs run at once by each app process
+job_workers = 2
+
+# Number of threads in each app process fetching and opening tiles ahead of
+# the one being written to a bundle
+tile_workers = 4
+
+# Number of tiles each app process downloads at once from url_path1/3
+fetch_workers = 4
+
+# Number of processes each app process generates missing tiles with
+generate_workers = 2
 
-app = Flask(__name__, static_url_path='/userRequestTerrain', static_folder=output_path,)
+# Python interpreter the tile generating processes run, or None for the one
+# running the app. Under uwsgi sys.executable is the uwsgi binary, so the
+# python3 of sys.exec_prefix is used instead
+generate_python = None
+
+# Most circles a request may cover, after splitting a route into circles
+max_areas = 10000
+
+# Most tiles in the database a request may cover, a few more than a 400km
+# radius covers anywhere
+max_tiles = 500
+
+# Most lattice rows of the circles of a request whose ends are found at once,
+# and most of their tiles listed at once
+area_batch_rows = 16 * 1024
+span_batch_tiles = 256 * 1024
+
+# Most waypoints, and bytes, of a route uploaded to /generate
+max_waypoints = 1000
+max_mission_bytes = 1024 * 1024
+
+# Most points in an /altitude request
+altitude_max_points = 100000
+
+# Let the web server send downloads instead of the app: None,
+# 'X-Accel-Redirect' (nginx) or 'X-Sendfile' (Apache, lighttpd, uwsgi)
+download_offload = None
+
+# URL prefix of the nginx internal location serving output_path, for X-Accel-Redirect
+offload_prefix = '/internal/userRequestTerrain/'
+
+# Seconds clients and proxies may cache a tile from /tiles for, unless it is
+# requested by its hash, which is cached for a year
+tile_max_age = 60 * 60
+
+# Rate limit of each client's /tiles requests for tiles which aren't already
+# held, and so have to be downloaded or generated
+tile_fetch_limit = "600 per hour"
+
+# Most samples in a /profile request
+profile_max_points = 100000
+
+# Distance (km) beyond the radius of a sparse request whose blocks are
+# still included
+sparse_margin = 1.0
+
+# Stream bundles to the user as they are built, instead of storing them
+# under output_path for download
+stream_bundles = False
+
+# generated files are served by download(), not as static files
+app = Flask(__name__, static_folder=None)
 # for example if the request goes through one proxy
 # before hitting your application server
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+metrics = Metrics()
+metrics.counter('terraingen_generate_requests_total', 'Terrain generation requests')
+metrics.counter('terraingen_bundle_cache_hits_total', 'Requests served from an existing bundle')
+metrics.counter('terraingen_bundle_cache_misses_total', 'Requests which built a new bundle')
+metrics.counter('terraingen_bundle_failures_total', 'Bundles which failed to build')
+metrics.counter('terraingen_streams_total', 'Streamed bundles')
+metrics.counter('terraingen_download_bytes_total', 'Bytes of tiles downloaded from the terrain server')
+metrics.counter('terraingen_files_expired_total', 'Expired files removed')
+metrics.counter('terraingen_dat_cache_hits_total', 'Tiles read from the decompressed tile cache')
+metrics.counter('terraingen_dat_cache_misses_total', 'Tiles decompressed into the decompressed tile cache')
+metrics.histogram('terraingen_tile_selection_seconds', 'Time to select the tiles of a request')
+metrics.histogram('terraingen_tile_open_seconds', 'Time to fetch and open a tile')
+metrics.histogram('terraingen_tile_copy_seconds', 'Time to copy a tile into a bundle')
+metrics.histogram('terraingen_bundle_seconds', 'Time to build a bundle')
+metrics.histogram('terraingen_bundle_bytes', 'Size of built bundles', SIZE_BUCKETS)
+metrics.histogram('terraingen_download_seconds', 'Time to download a tile from the terrain server')
+metrics.histogram('terraingen_sweep_seconds', 'Time to sweep expired files')
+metrics.counter('terraingen_tiles_generated_total', 'Missing tiles generated from the HGT data')
+metrics.histogram('terraingen_tile_generate_seconds', 'Time to generate a missing tile')
+
+jobs = concurrent.futures.ThreadPoolExecutor(max_workers=job_workers)
+tile_pool = concurrent.futures.ThreadPoolExecutor(max_workers=tile_workers)
+fetchers = {}
+fetchers_lock = threading.Lock()
+file_indexes = {}
+file_indexes_lock = threading.Lock()
+file_stores = {}
+dat_caches = {}
+dat_caches_lock = threading.Lock()
+catalogs = {}
+catalogs_lock = threading.Lock()
+sweeper_pid = None
+metrics_saver_pid = None
+active_jobs = set()
+active_jobs_lock = threading.Lock()
+heartbeat_pid = None
+generator_pool = None
+generator_pid = None
+generating = {}
+generating_lock = threading.Lock()
+# the fields of a DAT block giving its position
+BLOCK_DTYPE = np.dtype({'names': ['lat', 'lon', 'spacing'], 'formats': ['<i4', '<i4', '<u2'],
+                        'offsets': [8, 12, 20], 'itemsize': IO_BLOCK_SIZE})
+
 limiter = Limiter(
     app,
     key_func=get_remote_address,
@@ -61,58 +276,810 @@ def getDatFile(lat, lon):
         EW = 'E'
     return "%c%02u%c%03u.DAT.gz" % (NS, min(abs(int(lat)), 99), EW, min(abs(int(lon)), 999))
 
-def compressFiles(fileList, uuidkey, version):
+def getTilePath(version):
+    '''Get the tile folder and terrain server URL for a dataset version'''
+    if version == 1:
+        return (tile_path1, url_path1)
+    elif version == 6:
+        return (tile_path6, url_path6)
+    elif version == 9:
+        return (tile_path9, url_path9)
+    else:
+        return (tile_path3, url_path3)
+
+def getSpacing(version):
+    '''Get the grid spacing (m) of a terrain version'''
+    return spacings[version]
+
+# The least tile latitude and longitude a radius of up to 400km touches, as
+# near the poles its rows pass beyond the pole and go round the world
+TILE_LAT_MIN = -100
+TILE_LON_MIN = -720
+
+def getTiles(lat, lon, radius, format="4.1"):
+    '''Get the (lat, lon) degree tiles touched by a radius (km) around a point
+
+    Gives the same tiles, in the same order, as applying add_offset to
+    every 1km cell of the (2*radius)^2 lattice around the point. Within a
+    row of the lattice the latitude is fixed and the longitude increases
+    monotonically by less than a degree per cell, so each row covers exactly
+    the tiles between its two ends and only those need to be evaluated.
+    '''
+    return list(getAreasTiles([(lat, lon, radius)], format))
+
+def getAreasTiles(areas, format="4.1"):
+    '''Generate the (lat, lon) degree tiles touched by any of areas=[(lat, lon, radius), ...],
+    each once, in the order getTiles gives them for each area in turn. The
+    ends of the rows of a batch of areas are found at once with add_offset's
+    arithmetic in numpy, and only rows reaching tiles not yet found are
+    expanded into their tiles'''
+    # the tiles found so far, from TILE_LAT_MIN, TILE_LON_MIN
+    found = np.zeros((-2 * TILE_LAT_MIN, -2 * TILE_LON_MIN), dtype=bool)
+    batch = []
+    rows = 0
+    for area in areas:
+        batch.append(area)
+        rows += 2 * area[2]
+        if rows >= area_batch_rows:
+            yield from rowSpanTiles(batch, found, format)
+            batch = []
+            rows = 0
+    if batch:
+        yield from rowSpanTiles(batch, found, format)
+
+def rowSpans(areas, format="4.1"):
+    '''Get the tile latitude and the westmost and eastmost tile longitudes of
+    each row of the lattices of areas, in the order of the areas and their
+    rows, leaving out rows spanning the same tiles as the row before'''
+    lat = np.array([area[0] for area in areas], dtype=np.float64) * 1e7
+    lon = np.array([area[1] for area in areas], dtype=np.float64) * 1e7
+    radius = np.array([area[2] for area in areas], dtype=np.int64)
+
+    # a row for each dx in range(-radius, radius) of each area
+    count = 2 * radius
+    area = np.repeat(np.arange(len(areas)), count)
+    dx = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) - radius[area]
+    lat_e7 = lat[area]
+    dlat = np.trunc(dx * 1000.0 * LOCATION_SCALING_FACTOR_INV)
+    if format == "pre-4.1":
+        scale = terrain_query.longitude_scale(lat_e7 * 1.0e-7)
+    else:
+        scale = terrain_query.longitude_scale((lat_e7 + dlat * 0.5) * 1.0e-7)
+    lon_west = np.trunc(lon[area] + np.trunc(-radius[area] * 1000.0 * LOCATION_SCALING_FACTOR_INV / scale))
+    lon_east = np.trunc(lon[area] + np.trunc((radius[area] - 1) * 1000.0 * LOCATION_SCALING_FACTOR_INV / scale))
+    lat_int = np.floor(np.trunc(lat_e7 + dlat) * 1.0e-7).astype(np.int64)
+    west = np.floor(lon_west * 1.0e-7).astype(np.int64)
+    # near the poles a row can go round more than once, which adds no more tiles
+    east = np.minimum(np.floor(lon_east * 1.0e-7).astype(np.int64), west + 359)
+
+    # neighbouring rows mostly span the same tiles
+    changed = np.ones(len(lat_int), dtype=bool)
+    changed[1:] = (lat_int[1:] != lat_int[:-1]) | (west[1:] != west[:-1]) | (east[1:] != east[:-1])
+    return (lat_int[changed], west[changed], east[changed])
+
+def rowSpanTiles(areas, found, format="4.1"):
+    '''Generate the tiles touched by the rows of the lattices of areas which
+    aren't in found, in the order of the areas, their rows and then
+    longitude, adding them to found. At most span_batch_tiles of the rows'
+    tiles are listed at once'''
+    (lat_int, west, east) = rowSpans(areas, format)
+    lat_int -= TILE_LAT_MIN
+    west -= TILE_LON_MIN
+    east -= TILE_LON_MIN
+    start = 0
+    while start < len(lat_int):
+        # leave out the rows whose tiles have all been found
+        counted = np.zeros((found.shape[0], found.shape[1] + 1), dtype=np.int32)
+        np.cumsum(found, axis=1, out=counted[:, 1:])
+        span = east[start:] - west[start:] + 1
+        keep = counted[lat_int[start:], east[start:] + 1] - counted[lat_int[start:], west[start:]] < span
+        keep = start + np.flatnonzero(keep)
+        if len(keep) == 0:
+            return
+        # at least one row, however long
+        span = east[keep] - west[keep] + 1
+        rows = keep[:max(1, np.searchsorted(np.cumsum(span), span_batch_tiles, side='right'))]
+        counts = east[rows] - west[rows] + 1
+        row = np.repeat(rows, counts)
+        tile_lat = lat_int[row]
+        tile_lon = west[row] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        # the first of each tile not already found
+        (keys, first) = np.unique(tile_lat * found.shape[1] + tile_lon, return_index=True)
+        first = np.sort(first[~found[tile_lat[first], tile_lon[first]]])
+        (tile_lat, tile_lon) = (tile_lat[first], tile_lon[first])
+        found[tile_lat, tile_lon] = True
+        yield from zip((tile_lat + TILE_LAT_MIN).tolist(), (tile_lon + TILE_LON_MIN).tolist())
+        start = rows[-1] + 1
+
+def inDatabase(lat_int, lon_int):
+    '''Whether a tile is inside the 84deg lat limit of the terrain database'''
+    return abs(lat_int) <= 84
+
+def getFileList(lat, lon, radius, version):
+    '''Get the tile files covering an area, and the tiles outside the database'''
+    return getAreasFileList([(lat, lon, radius)], version)
+
+def parseRequest(values):
+    '''Parse and sanitise the area and version of a request'''
+    lat = float(values['lat'])
+    lon = float(values['long'])
+    radius = int(values['radius'])
+    version = int(values['version'])
+    assert lat < 90
+    assert lon < 180
+    assert lat > -90
+    assert lon > -180
+    assert version in spacings
+    radius = clamp(radius, 1, 400)
+    return (lat, lon, radius, version)
+
+def parseWaypoints(text):
+    '''Parse a route from a QGC WPL mission file, or from lines of "lat, lon"'''
+    lines = text.splitlines()
+    points = []
+    if lines and lines[0].startswith('QGC WPL'):
+        for line in lines[1:]:
+            fields = line.split()
+            if len(fields) < 12:
+                continue
+            (lat, lon) = (float(fields[8]), float(fields[9]))
+            if lat == 0 and lon == 0:
+                # a command without a position
+                continue
+            points.append((lat, lon))
+    else:
+        for line in lines:
+            fields = line.replace(',', ' ').split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            points.append((float(fields[0]), float(fields[1])))
+    assert 1 <= len(points) <= max_waypoints
+    for (lat, lon) in points:
+        assert -90 < lat < 90
+        assert -180 < lon < 180
+    return points
+
+def getCorridorAreas(points, width):
+    '''Get circles covering a corridor width (km) wide along a route. Circles
+    every half width, of radius sqrt(5)/4 of the width, cover the corridor'''
+    half = clamp(width, 1, 400) / 2.0
+    radius = int(math.ceil(half * math.sqrt(5) / 2))
+    # checked before the circles are made, as a long route could need too many to hold
+    length = terrain_query.leg_lengths([p[0] for p in points], [p[1] for p in points]).sum()
+    assert len(points) + length / (half * 1000) + 2 <= max_areas
+    (distance, lat, lon) = terrain_query.densify([p[0] for p in points], [p[1] for p in points],
+                                                 half * 1000)
+    # and the turns
+    return [(lat, lon, radius) for (lat, lon) in points] + \
+        [(float(a), float(b), radius) for (a, b) in zip(lat, lon)]
+
+def parseAreas(values, files=None):
+    '''Parse and sanitise the areas and version of a request: the circle
+    around lat, long and any others listed in areas, or a corridor along a
+    route given by waypoints or an uploaded mission file.
+    Returns ([(lat, lon, radius), ...], version)'''
+    route = values.get('waypoints', '')
+    if files is not None and files.get('mission') and files['mission'].filename:
+        route = files['mission'].read(max_mission_bytes).decode('utf-8', 'replace')
+    if route.strip():
+        version = int(values['version'])
+        assert version in spacings
+        areas = getCorridorAreas(parseWaypoints(route), float(values['corridor']))
+    else:
+        (lat, lon, radius, version) = parseRequest(values)
+        areas = [(lat, lon, radius)]
+        for line in values.get('areas', '').splitlines():
+            fields = line.replace(',', ' ').split()
+            if not fields:
+                continue
+            (lat, lon, radius) = fields
+            (lat, lon, radius, version) = parseRequest(dict(lat=lat, long=lon, radius=radius, version=version))
+            areas.append((lat, lon, radius))
+    assert len(areas) <= max_areas
+    return (areas, version)
+
+def getAreasFileList(areas, version):
+    '''Get the tile files covering several areas, each only once, and the tiles
+    outside the database. Raises ValueError if they cover more than max_tiles'''
+    # tiles the user wanted outside +-84deg latitude
+    outside = []
+
+    filelist = []
+
+    format = "4.1"
+
+    (tile_path, url_path) = getTilePath(version)
+
+    for (lat_int, lon_int) in getAreasTiles(areas, format):
+        if inDatabase(lat_int, lon_int):
+            filelist.append(os.path.join(tile_path, getDatFile(lat_int, lon_int)))
+            if len(filelist) > max_tiles:
+                # stopped before the rest of the areas are looked at
+                raise ValueError("Areas cover more than %u tiles" % max_tiles)
+        else:
+            outside.append(getDatFile(lat_int, lon_int))
+
+    # remove duplicates
+    return (list(dict.fromkeys(filelist)), list(dict.fromkeys(outside)))
+
+def getFetcher(url_path, tile_path):
+    '''Get the fetcher caching tiles from a terrain server in a tile folder'''
+    with fetchers_lock:
+        if (url_path, tile_path) not in fetchers:
+            fetchers[(url_path, tile_path)] = TileFetcher(url_path, tile_path, fetch_workers,
+                                                          metrics=metrics)
+        return fetchers[(url_path, tile_path)]
+
+def getCatalog(tile_path):
+    '''Get the catalog of the tiles held in a tile folder'''
+    with catalogs_lock:
+        if tile_path not in catalogs:
+            catalogs[tile_path] = TileCatalog(tile_path, catalog_interval)
+        return catalogs[tile_path]
+
+def loadCatalogs():
+    '''Build the catalogs of the tile folders of every version'''
+    for version in sorted(spacings):
+        getCatalog(getTilePath(version)[0]).refresh()
+
+def tileExists(fn):
+    '''Whether a tile is held locally'''
+    return getCatalog(os.path.dirname(fn)).get(os.path.basename(fn)) != None
+
+def fetchTile(fn, url_path):
+    '''Download a tile from the terrain server, or generate it from the HGT
+    data, if it isn't held locally. Returns its catalog entry, or None if
+    there is no such tile'''
+    catalog = getCatalog(os.path.dirname(fn))
+    name = os.path.basename(fn)
+    entry = catalog.get(name)
+    if entry != None:
+        return entry
+    if url_path != None:
+        getFetcher(url_path, os.path.dirname(fn)).fetch(name).result()
+    elif canGenerate(fn):
+        generateTile(fn)
+    else:
+        return None
+    return catalog.update(name)
+
+def getHgtPath(tile_path):
+    '''Get the HGT data and grid spacing (m) to generate the tiles in tile_path
+    from, or None'''
+    hgt_paths = {1: hgt_path1, 3: hgt_path3, 6: hgt_path6, 9: hgt_path9}
+    for version in sorted(spacings):
+        if tile_path == getTilePath(version)[0] and hgt_paths[version] != None:
+            return (hgt_paths[version], getSpacing(version))
+    return None
+
+def canGenerate(fn):
+    '''Whether a missing tile can be generated on demand'''
+    return getHgtPath(os.path.dirname(fn)) != None
+
+def getGeneratorPython():
+    '''Get the Python interpreter to spawn tile generating processes with'''
+    if generate_python != None:
+        return generate_python
+    if os.path.basename(sys.executable).startswith('python'):
+        return sys.executable
+    # embedded, such as in uwsgi
+    return os.path.join(sys.exec_prefix, 'bin', 'python3')
+
+def getGeneratorPool():
+    '''Get this app process's pool of processes generating tiles'''
+    global generator_pool, generator_pid
+    with generating_lock:
+        if generator_pid != os.getpid() or generator_pool == None:
+            # spawned, as forking a threaded process isn't safe
+            context = multiprocessing.get_context('spawn')
+            context.set_executable(getGeneratorPython())
+            generator_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=generate_workers, mp_context=context)
+            generator_pid = os.getpid()
+        return generator_pool
+
+def resetGeneratorPool(pool):
+    '''Replace a pool broken by one of its processes dying, so the next tile
+    is generated in a new one'''
+    global generator_pool
+    with generating_lock:
+        if generator_pool is pool:
+            generator_pool = None
+    pool.shutdown(wait=False)
+
+def generateTile(fn):
+    '''Generate a missing tile. Concurrent requests for the tile, from any app
+    process, share a single generation'''
+    with generating_lock:
+        future = generating.get(fn)
+        owner = future is None
+        if owner:
+            future = generating[fn] = concurrent.futures.Future()
+    if not owner:
+        # another request in this process is generating it
+        future.result()
+        return
+    try:
+        generateTileOnce(fn)
+        future.set_result(fn)
+    except Exception as ex:
+        future.set_exception(ex)
+        raise
+    finally:
+        with generating_lock:
+            del generating[fn]
+
+def generateTileOnce(fn):
+    '''Generate a missing tile, unless another app process has done so already'''
+    (hgt_path, spacing) = getHgtPath(os.path.dirname(fn))
+    key = 'tile-%s-%s' % (os.path.basename(os.path.dirname(fn)), os.path.basename(fn))
+    with buildLock(key):
+        if os.path.exists(fn):
+            return
+        print("Generating " + fn)
+        start = time.monotonic()
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        pool = getGeneratorPool()
+        try:
+            pool.submit(fast_gen.generate_tile, fn, hgt_path, spacing).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            # a process was killed, such as by the OOM killer, so try once more in a new pool
+            resetGeneratorPool(pool)
+            getGeneratorPool().submit(fast_gen.generate_tile, fn, hgt_path, spacing).result()
+        metrics.inc('terraingen_tiles_generated_total')
+        metrics.observe('terraingen_tile_generate_seconds', time.monotonic() - start)
+
+def openTile(fn, url_path):
+    '''Download a tile if required, then open it ready to add to a zip'''
+    with metrics.time('terraingen_tile_open_seconds'):
+        entry = fetchTile(fn, url_path)
+        f = open(fn, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            if entry != None and (st.st_size, st.st_mtime_ns) == (entry.size, entry.mtime_ns):
+                return (f, entry.member)
+            # changed since it was catalogued
+            return (f, read_gzip_member(f))
+        except:
+            f.close()
+            raise
+
+def getDatCache():
+    '''Get the cache of decompressed tiles'''
+    with dat_caches_lock:
+        if dat_cache_path not in dat_caches:
+            dat_caches[dat_cache_path] = DatCache(dat_cache_path, dat_cache_bytes, metrics)
+        return dat_caches[dat_cache_path]
+
+def readTile(fn, url_path):
+    '''Download a tile if required, then get its decompressed contents'''
+    if fetchTile(fn, url_path) == None:
+        raise FileNotFoundError(fn)
+    return getDatCache().get(fn)
+
+def readTileAt(lat_int, lon_int, version):
+    '''Get the decompressed contents of the tile at lat_int, lon_int, or None if there isn't one'''
+    if not inDatabase(lat_int, lon_int):
+        return None
+    (tile_path, url_path) = getTilePath(version)
+    try:
+        return readTile(os.path.join(tile_path, getDatFile(lat_int, lon_int)), url_path)
+    except (OSError, EOFError):
+        return None
+
+def closeTile(future):
+    '''Close a tile opened in the background which is no longer needed'''
+    if future.exception() is None:
+        future.result()[0].close()
+
+def prepareTiles(fileList, prepare, discard=None):
+    '''Generate (fn, prepare(fn)) for the tiles in order, preparing the next
+    few in the background. discard is added as a done callback to the futures
+    of any tiles prepared ahead of a failure, and the tiles not yet started
+    are never prepared'''
+    files = iter(fileList)
+    pending = collections.deque()
+    for fn in itertools.islice(files, 2 * tile_workers):
+        pending.append((fn, tile_pool.submit(prepare, fn)))
+    try:
+        while pending:
+            (fn, future) = pending.popleft()
+            result = future.result()
+            for next_fn in itertools.islice(files, 1):
+                pending.append((next_fn, tile_pool.submit(prepare, next_fn)))
+            yield (fn, result)
+    finally:
+        for (fn, future) in pending:
+            if not future.cancel() and discard != None:
+                future.add_done_callback(discard)
+
+def openTiles(fileList, url_path):
+    '''Generate the opened tiles in order, opening the next few in the background'''
+    # close anything opened ahead of a failure
+    for (fn, (f, member)) in prepareTiles(fileList, lambda fn: openTile(fn, url_path), closeTile):
+        with f:
+            yield (fn, f, member)
+
+def blocksWithin(blocks, lat, lon, radius):
+    '''Whether each block is within radius (km) plus sparse_margin of lat, lon'''
+    spacing = blocks['spacing'].astype(np.float64)
+
+    # position of the south west corner of each block relative to the centre
+    dlat = blocks['lat'].astype(np.int64) - int(lat * 1.0e7)
+    dlon = (blocks['lon'].astype(np.int64) - int(lon * 1.0e7) + 1800000000) % 3600000000 - 1800000000
+    north = dlat * LOCATION_SCALING_FACTOR
+    east = dlon * LOCATION_SCALING_FACTOR * longitude_scale(lat)
+
+    # distance from the centre to the nearest point of each block
+    north = np.maximum(np.maximum(north, -north - (TERRAIN_GRID_BLOCK_SIZE_X - 1) * spacing), 0)
+    east = np.maximum(np.maximum(east, -east - (TERRAIN_GRID_BLOCK_SIZE_Y - 1) * spacing), 0)
+    return (spacing > 0) & (north**2 + east**2 <= ((radius + sparse_margin) * 1000)**2)
+
+def areasNear(areas, lat_int, lon_int):
+    '''Get the areas=[(lat, lon, radius), ...] which could reach the tile lat_int, lon_int'''
+    (lat, lon, radius) = np.array(areas, dtype=np.float64).reshape(-1, 3).T
+    # degrees of latitude and longitude within reach, generously
+    reach = (radius + sparse_margin + 1) / 110.0
+    scale = max(math.cos(math.radians(min(max(abs(lat_int), abs(lat_int + 1)), 89))), 0.01)
+    dlon = (lon - (lon_int + 0.5) + 180) % 360 - 180
+    near = ((lat >= lat_int - reach) & (lat <= lat_int + 1 + reach) &
+            (np.abs(dlon) <= 0.5 + reach / scale))
+    return [areas[i] for i in np.flatnonzero(near)]
+
+def sparseBlocks(fn, data, areas):
+    '''Whether each block of a tile is within the radius (km) of any of
+    areas=[(lat, lon, radius), ...] plus sparse_margin'''
+    count = len(data) // IO_BLOCK_SIZE
+    blocks = np.frombuffer(data, dtype=BLOCK_DTYPE, count=count)
+    keep = np.zeros(count, dtype=bool)
+    position = tile_position(os.path.basename(fn))
+    if position != None:
+        areas = areasNear(areas, position[0], position[1])
+    for (lat, lon, radius) in areas:
+        keep |= blocksWithin(blocks, lat, lon, radius)
+    return keep
+
+def sparseTile(fn, url_path, areas):
+    '''Get the contents of a tile with only the blocks within the radius (km)
+    of any of areas=[(lat, lon, radius), ...] plus sparse_margin. The other
+    blocks are zeroed, or truncated from the end, which AP_Terrain treats as
+    missing. None if no blocks are within the radius'''
+    data = readTile(fn, url_path)
+    keep = sparseBlocks(fn, data, areas)
+    if not keep.any():
+        return None
+
+    last = np.flatnonzero(keep)[-1] + 1
+    keep = keep[:last]
+    src = np.frombuffer(data, dtype=np.uint8, count=last * IO_BLOCK_SIZE).reshape(last, IO_BLOCK_SIZE)
+    out = np.zeros((last, IO_BLOCK_SIZE), dtype=np.uint8)
+    out[keep] = src[keep]
+    return out.tobytes()
+
+def sparseTiles(fileList, url_path, areas):
+    '''Generate the sparse contents of the tiles in order, preparing the next few in the background'''
+    for (fn, data) in prepareTiles(fileList, lambda fn: sparseTile(fn, url_path, areas)):
+        if data is not None:
+            yield (fn, data)
+
+def compressFiles(fileList, zipthis, version, progress=None, areas=None):
     # create a zip file comprised of dat.gz tiles
-    zipthis = os.path.join(output_path, uuidkey + '.zip')
 
     # create output dirs if needed
     try:
         os.makedirs(output_path)
     except OSError:
         pass
-    version = int(version)
-    if version == 1:
-        url_path = url_path1
-        try:
-            os.makedirs(tile_path1)
-        except OSError:
-            pass
-    elif version == 3:
-        url_path = url_path3
-        try:
-            os.makedirs(tile_path3)
-        except OSError:
-            pass
+    (tile_path, url_path) = getTilePath(int(version))
+    try:
+        os.makedirs(tile_path)
+    except OSError:
+        pass
 
     print("compressFiles: version=%u url_path=%s" % (version, url_path))
-            
-    try:
-        with zipfile.ZipFile(zipthis, 'w') as terrain_zip:
-            for fn in fileList:
-                if not os.path.exists(fn) and url_path != None:
-                    #download if required
-                    print("Downloading " + os.path.basename(fn))
-                    g = urllib.request.urlopen(url_path +
-                                               os.path.basename(fn))
-                    print("Downloaded " + os.path.basename(fn))
-                    with open(fn, 'b+w') as f:
-                        f.write(g.read())
-
-                # need to decompress file and pass to zip
-                with gzip.open(fn, 'r') as f_in:
-                    myio = BytesIO(f_in.read())
-                    print("Decomp " + os.path.basename(fn))
-
-                    # and add file to zip
-                    terrain_zip.writestr(os.path.basename(fn)[:-3], myio.read(),
-                                         compress_type=zipfile.ZIP_DEFLATED)
 
+    try:
+        with metrics.time('terraingen_bundle_seconds'):
+            with open(zipthis, 'wb', buffering=0) as f_out, ZipWriter(f_out) as terrain_zip:
+                if areas is not None:
+                    # only the blocks within the areas
+                    for (fn, data) in sparseTiles(fileList, url_path, areas):
+                        with metrics.time('terraingen_tile_copy_seconds'):
+                            terrain_zip.add_data(os.path.basename(fn)[:-3], data)
+                        if progress:
+                            progress(len(terrain_zip.entries), terrain_zip.offset)
+                else:
+                    for (fn, f, member) in openTiles(fileList, url_path):
+                        # pass the compressed data straight through to the zip
+                        with metrics.time('terraingen_tile_copy_seconds'):
+                            terrain_zip.add_member(os.path.basename(fn)[:-3], f, member)
+                        if progress:
+                            progress(len(terrain_zip.entries), terrain_zip.offset)
+
+    except Exception as ex:
+        print("Unexpected error: {0}".format(ex))
+        metrics.inc('terraingen_bundle_failures_total')
+        return False
+
+    metrics.observe('terraingen_bundle_bytes', terrain_zip.offset)
+    return True
+
+def streamFiles(fileList, version, areas=None):
+    '''Generate a zip file comprised of dat.gz tiles, while it is being sent'''
+    (tile_path, url_path) = getTilePath(version)
+    try:
+        os.makedirs(tile_path)
+    except OSError:
+        pass
+
+    print("streamFiles: version=%u url_path=%s" % (version, url_path))
+
+    metrics.inc('terraingen_streams_total')
+    terrain_zip = ZipWriter(None, streaming=True)
+    try:
+        if areas is not None:
+            for (fn, data) in sparseTiles(fileList, url_path, areas):
+                for chunk in terrain_zip.iter_data(os.path.basename(fn)[:-3], data):
+                    yield chunk
+        else:
+            for (fn, f, member) in openTiles(fileList, url_path):
+                for chunk in terrain_zip.iter_member(os.path.basename(fn)[:-3], f, member):
+                    yield chunk
+        yield terrain_zip.central_directory()
     except Exception as ex:
+        # too late to report an error, the client gets a truncated zip
         print("Unexpected error: {0}".format(ex))
+        raise
+
+def fetchTiles(fileList, url_path):
+    '''Download or generate the tiles which aren't held locally, a few at once,
+    returning their catalog entries, or None for tiles which don't exist.
+    Raises the first failure, without starting on the rest'''
+    return [entry for (fn, entry) in prepareTiles(fileList, lambda fn: fetchTile(fn, url_path))]
+
+def heldTiles(fileList):
+    '''Get the catalog entries of the tiles held locally, or None'''
+    return [getCatalog(os.path.dirname(fn)).get(os.path.basename(fn)) for fn in fileList]
+
+def fetchTilesOrHeld(fileList, url_path):
+    '''Get the catalog entries of the tiles, downloading or generating those
+    which aren't held a few at once. Once one fails no more are started, and
+    the tiles not held are None'''
+    try:
+        return fetchTiles(fileList, url_path)
+    except Exception as ex:
+        print("Failed to fetch tiles: {0}".format(ex))
+        return heldTiles(fileList)
+
+def bundleKey(fileList, version, areas=None):
+    '''Get a key identifying the bundle for a set of tiles, from their names
+    and contents, and the areas of a sparse bundle'''
+    tiles = []
+    for fn in sorted(fileList, key=os.path.basename):
+        name = os.path.basename(fn)
+        entry = getCatalog(os.path.dirname(fn)).get(name)
+        if entry == None:
+            tiles.append(name)
+        else:
+            # so a regenerated tile gives a new bundle
+            tiles.append("%s:%08x:%u" % (name, entry.member.crc, entry.member.isize))
+    key = "%u:%s" % (version, ",".join(tiles))
+    if areas is not None:
+        key += ":" + ";".join("%.9f,%.9f,%.3f" % tuple(area) for area in areas) + ",%.3f" % sparse_margin
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def linkBundle(bundle, zipthis):
+    '''Give a request its own name for a bundle'''
+    try:
+        os.link(bundle, zipthis)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # no hard links on this filesystem
+        shutil.copyfile(bundle, zipthis)
+
+def storeBundle(bundle, zipthis=None):
+    '''Record a bundle, and the request's link to it, in the store, returning
+    whether the bundle is still there'''
+    if zipthis != None:
+        # first, so the request's file is kept however the bundle fares
+        getFileStore().add(zipthis)
+    try:
+        getFileStore().add(bundle)
+    except FileNotFoundError:
+        # evicted by a sweeper since it was linked or built
+        return False
+    return True
+
+@contextlib.contextmanager
+def buildLock(key):
+    '''Hold the lock on building a bundle or tile, shared with the other app processes'''
+    try:
+        os.makedirs(lock_path)
+    except OSError:
+        pass
+    lock = os.path.join(lock_path, key + '.lock')
+    with open(lock, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        getFileIndex().add(lock)
+        yield
+
+def generateBundle(fileList, uuidkey, version, progress=None, areas=None):
+    '''Make <uuidkey>.zip available, reusing any bundle of the same tiles'''
+    zipthis = os.path.join(output_path, uuidkey + '.zip')
+    try:
+        fetchTiles(fileList, getTilePath(version)[1])
+    except Exception as ex:
+        # as the bundle would fail on the same tile
+        print("Failed to fetch tiles: {0}".format(ex))
+        metrics.inc('terraingen_bundle_failures_total')
         return False
+    key = bundleKey(fileList, version, areas)
+    bundle = os.path.join(output_path, 'bundle-' + key + '.zip')
+
+    try:
+        # linking first means the bundle can't be expired from under us
+        linkBundle(bundle, zipthis)
+    except FileNotFoundError:
+        # only one request builds a bundle, any others wait and share it
+        with buildLock(key):
+            try:
+                linkBundle(bundle, zipthis)
+            except FileNotFoundError:
+                metrics.inc('terraingen_bundle_cache_misses_total')
+                tmp = bundle + '.' + uuidkey + '.tmp'
+                if not compressFiles(fileList, tmp, version, progress, areas):
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    return False
+                linkBundle(tmp, zipthis)
+                os.replace(tmp, bundle)
+                storeBundle(bundle, zipthis)
+                return True
 
+    print("Reusing " + os.path.basename(bundle))
+    metrics.inc('terraingen_bundle_cache_hits_total')
+    # the bundle is as good as new
+    storeBundle(bundle, zipthis)
     return True
 
+def tileTag(entry):
+    '''Get the ETag of a tile file from its catalog entry: the CRC32 and size
+    of its .DAT, and the size and modification time of the file, so it is the
+    same in every app process without reading the file'''
+    return "%08x-%x-%x-%x" % (entry.member.crc, entry.member.isize, entry.size, entry.mtime_ns)
+
+def warmBundle(fileList, version):
+    '''Build the bundle for a set of tiles ahead of a request for it,
+    returning whether it had to be built'''
+    fetchTiles(fileList, getTilePath(version)[1])
+    key = bundleKey(fileList, version)
+    bundle = os.path.join(output_path, 'bundle-' + key + '.zip')
+    with buildLock(key):
+        # the bundle is as good as new
+        if storeBundle(bundle):
+            return False
+        metrics.inc('terraingen_bundle_cache_misses_total')
+        tmp = bundle + '.%u.tmp' % os.getpid()
+        if not compressFiles(fileList, tmp, version):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise IOError("Failed to build " + os.path.basename(bundle))
+        os.replace(tmp, bundle)
+        storeBundle(bundle)
+        return True
+
+def bundleETag(path):
+    '''Get a strong ETag for a bundle, from the names, CRCs and sizes of its
+    tiles in its central directory, but not when it was built'''
+    with open(path, 'rb') as f:
+        entries = central_directory_entries(read_central_directory(f))
+    tiles = "".join("%s:%08x:%u:%u\n" % entry for entry in entries)
+    return hashlib.sha256(tiles.encode()).hexdigest()
+
+def writeJobStatus(uuidkey, state, tiles_done, tiles_total, bytes_written):
+    '''Record the progress of a generation job, for any app process to report'''
+    status = os.path.join(job_path, uuidkey + '.json')
+    with open(status + '.tmp', 'w') as f:
+        json.dump(dict(state=state, tiles_done=tiles_done, tiles_total=tiles_total,
+                       bytes_written=bytes_written,
+                       url="/userRequestTerrain/" + uuidkey + ".zip"), f)
+    os.replace(status + '.tmp', status)
+
+def startHeartbeat():
+    '''Start marking this process's jobs as alive, once per app process'''
+    global heartbeat_pid
+    with active_jobs_lock:
+        if heartbeat_pid == os.getpid():
+            return
+        heartbeat_pid = os.getpid()
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+def heartbeat():
+    '''Mark the status of this process's queued and running jobs as recently updated'''
+    while True:
+        time.sleep(job_heartbeat)
+        with active_jobs_lock:
+            uuidkeys = list(active_jobs)
+        for uuidkey in uuidkeys:
+            try:
+                os.utime(os.path.join(job_path, uuidkey + '.json'))
+            except OSError:
+                pass
+
+def runJob(fileList, uuidkey, version, areas=None):
+    '''Generate the bundle for a background job'''
+    def progress(tiles_done, bytes_written):
+        writeJobStatus(uuidkey, 'running', tiles_done, len(fileList), bytes_written)
+
+    progress(0, 0)
+    try:
+        success = generateBundle(fileList, uuidkey, version, progress, areas)
+    except Exception as ex:
+        print("Unexpected error: {0}".format(ex))
+        success = False
+
+    if success:
+        print("Generated " + "/terrain/" + uuidkey + ".zip")
+        zipthis = os.path.join(output_path, uuidkey + '.zip')
+        writeJobStatus(uuidkey, 'done', len(fileList), len(fileList), os.path.getsize(zipthis))
+    else:
+        print("Failed " + "/terrain/" + uuidkey + ".zip")
+        writeJobStatus(uuidkey, 'failed', 0, len(fileList), 0)
+    with active_jobs_lock:
+        active_jobs.discard(uuidkey)
+    metrics.save(metrics_path)
+
+def getFileIndex():
+    '''Get the index of generated files'''
+    with file_indexes_lock:
+        if index_path not in file_indexes:
+            file_indexes[index_path] = sweeper.FileIndex(index_path)
+        return file_indexes[index_path]
+
+def getFileStore():
+    '''Get the index of generated bundles, which limits their total size'''
+    key = (index_path, store_quota, store_min_age)
+    with file_indexes_lock:
+        if key not in file_stores:
+            file_stores[key] = sweeper.FileStore(index_path, store_quota, store_min_age)
+        return file_stores[key]
+
+@app.before_request
+def startSweeper():
+    '''Start expiring generated files in the background, once per app process'''
+    global sweeper_pid
+    if sweep_interval is None or sweeper_pid == os.getpid():
+        return
+    sweeper_pid = os.getpid()
+    threading.Thread(target=sweeper.run, daemon=True,
+                     args=(getFileIndex(), [job_path, lock_path], 24 * 60 * 60, sweep_interval,
+                           metrics, getFileStore(), [output_path], metrics_path)).start()
+
+@app.context_processor
+def downloadLifetime():
+    '''How long downloads are kept for, at least'''
+    return dict(download_hours=max(1, int(store_min_age // 3600)))
+
+@app.before_request
+def startMetricsSaver():
+    '''Start sharing this process's metrics with the others, once per app process'''
+    global metrics_saver_pid
+    if metrics_saver_pid == os.getpid():
+        return
+    metrics_saver_pid = os.getpid()
+    threading.Thread(target=saveMetrics, daemon=True).start()
+
+def saveMetrics():
+    '''Save this process's metrics every metrics_interval seconds, if they have changed'''
+    while True:
+        try:
+            metrics.save(metrics_path)
+        except OSError as ex:
+            print("Saving metrics failed: {0}".format(ex))
+        time.sleep(metrics_interval)
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -122,69 +1089,66 @@ def generate():
     if request.method == 'POST':
         # parse and sanitise the input
         try:
-            # request.form['username']
-            lat = float(request.form['lat'])
-            lon = float(request.form['long'])
-            radius = int(request.form['radius'])
-            version = int(request.form['version'])
-            assert lat < 90
-            assert lon < 180
-            assert lat > -90
-            assert lon > -180
-            assert version in [1, 3]
-            radius = clamp(radius, 1, 400)
+            (areas, version) = parseAreas(request.form, request.files)
         except:
             print("Bad data")
             return render_template('generate.html', error="Error with input")
 
-        version = int(version)
-        print("Generate: %.9f %.9f %.3f version=%u" % (lat, lon, radius, version))
+        (lat, lon, radius) = areas[0]
+        if len(areas) == 1:
+            print("Generate: %.9f %.9f %.3f version=%u" % (lat, lon, radius, version))
+        else:
+            print("Generate: %u areas version=%u" % (len(areas), version))
+
+        # only include the blocks within the radius
+        sparse = request.form.get('sparse') == '1'
 
         # UUID for this terrain generation
         uuidkey = str(uuid.uuid1())
 
-        # Flag for if user wanted a tile outside +-84deg latitude
-        outsideLat = None
+        metrics.inc('terraingen_generate_requests_total')
 
-        # get a list of files required to cover area
-        filelist = []
-        done = set()
-        
-        format = "4.1"
-        
+        # get a list of files required to cover the areas, each once
+        try:
+            with metrics.time('terraingen_tile_selection_seconds'):
+                (filelist, outside) = getAreasFileList(areas, version)
+        except ValueError:
+            print("Too many tiles")
+            return render_template('generate.html', error="Too many tiles, choose smaller areas",
+                                   uuidkey=uuidkey)
+        print(filelist)
 
-        if version == 1:
-            tile_path = tile_path1
-        else:
-            tile_path = tile_path3
-
-        for dx in range(-radius, radius):
-            for dy in range(-radius, radius):
-                (lat2, lon2) = add_offset(lat*1e7, lon*1e7, dx*1000.0, dy*1000.0, format)
-                lat_int = int(math.floor(lat2 * 1.0e-7))
-                lon_int = int(math.floor(lon2 * 1.0e-7))
-                tag = (lat_int, lon_int)
-                if tag in done:
-                    continue
-                done.add(tag)
-                # make sure tile is inside the 84deg lat limit
-                if abs(lat_int) <= 84:
-                    filelist.append(os.path.join(tile_path, getDatFile(lat_int, lon_int)))
-                else:
-                    outsideLat = True
+        # Flag for if user wanted a tile outside +-84deg latitude
+        outsideLat = True if outside else None
 
-        # remove duplicates
-        filelist = list(dict.fromkeys(filelist))
-        print(filelist)
+        if stream_bundles and len(areas) == 1:
+            # the zip is built as it is downloaded
+            if sparse:
+                urlkey = url_for('stream', lat=lat, long=lon, radius=radius, version=version, sparse=1)
+            else:
+                urlkey = url_for('stream', lat=lat, long=lon, radius=radius, version=version)
+            print("Streaming " + urlkey)
+            return render_template('generate.html', urlkey=urlkey,
+                                   uuidkey=uuidkey, outsideLat=outsideLat)
 
-        #compress
-        success = compressFiles(filelist, uuidkey, version)
+        if async_tiles is not None and len(filelist) >= async_tiles:
+            # large request, leave the web worker free while it is generated
+            try:
+                os.makedirs(job_path)
+            except OSError:
+                pass
+            writeJobStatus(uuidkey, 'queued', 0, len(filelist), 0)
+            getFileIndex().add(os.path.join(job_path, uuidkey + '.json'))
+            with active_jobs_lock:
+                active_jobs.add(uuidkey)
+            startHeartbeat()
+            jobs.submit(runJob, filelist, uuidkey, version, areas if sparse else None)
+            print("Queued " + "/terrain/" + uuidkey + ".zip")
+            return render_template('generate.html', urlkey="/userRequestTerrain/" + uuidkey + ".zip",
+                                   uuidkey=uuidkey, outsideLat=outsideLat, pending=True)
 
-        # as a cleanup, remove any generated terrain older than 24H
-        for f in os.listdir(output_path):
-            if os.stat(os.path.join(output_path, f)).st_mtime < time.time() - 24 * 60 * 60:
-                print("Removing old file: " + str(os.path.join(output_path, f)))
-                os.remove(os.path.join(output_path, f))
+        #compress
+        success = generateBundle(filelist, uuidkey, version, areas=areas if sparse else None)
 
         if success:
             print("Generated " + "/terrain/" + uuidkey + ".zip")
@@ -198,5 +1162,247 @@ def generate():
         print("Bad get")
         return render_template('generate.html', error="Need to use POST, not GET")
 
+@app.route('/status/<uuidkey>')
+@limiter.exempt
+def status(uuidkey):
+    '''Report the progress of a background job, polled by generate.html'''
+    try:
+        uuidkey = str(uuid.UUID(uuidkey))
+        with open(os.path.join(job_path, uuidkey + '.json')) as f:
+            job = json.load(f)
+            updated = os.fstat(f.fileno()).st_mtime
+    except (ValueError, OSError):
+        return jsonify(state='unknown'), 404
+    if job['state'] in ('queued', 'running') and time.time() - updated > job_stale:
+        # the app process running it has gone
+        job['state'] = 'failed'
+    return jsonify(job)
+
+@app.route('/userRequestTerrain/<name>')
+@limiter.exempt
+def download(name):
+    '''Send a generated bundle, supporting Range, If-Range and If-None-Match so
+    interrupted downloads can resume'''
+    path = safe_join(output_path, name)
+    if path is None or not name.endswith('.zip') or not os.path.isfile(path):
+        abort(404)
+    # keep the most recently downloaded bundles
+    getFileStore().touch(path)
+
+    if download_offload != None:
+        # the web server sends the file, and handles ranges itself
+        response = Response(mimetype='application/zip')
+        if download_offload == 'X-Accel-Redirect':
+            response.headers['X-Accel-Redirect'] = offload_prefix + name
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        return response
+
+    try:
+        etag = bundleETag(path)
+    except (OSError, ValueError):
+        abort(404)
+    return send_file(path, mimetype='application/zip', conditional=True, etag=etag)
+
+@app.route('/plan', methods=['GET', 'POST'])
+@limiter.limit("600 per hour")
+def plan():
+    '''Report the tiles and download size of a request, without generating it'''
+    try:
+        (areas, version) = parseAreas(request.values, request.files)
+        (filelist, outside) = getAreasFileList(areas, version)
+    except:
+        print("Bad data")
+        return jsonify(error="Error with input"), 400
+
+    (tile_path, url_path) = getTilePath(version)
+    if url_path != None:
+        held = fetchTilesOrHeld(filelist, url_path)
+    else:
+        held = heldTiles(filelist)
+
+    # sized as the sparse bundle which would be built
+    sparse = request.values.get('sparse') == '1'
+    tiles = []
+    missing = []
+    generate = []
+    entries = []
+    for (fn, entry) in zip(filelist, held):
+        name = os.path.basename(fn)[:-3]
+        if url_path == None and entry == None and canGenerate(fn):
+            # generated when the bundle is built, size unknown until then
+            generate.append(name)
+            continue
+        if entry == None:
+            missing.append(name)
+            continue
+        member = entry.member
+        if sparse:
+            try:
+                keep = sparseBlocks(fn, readTile(fn, url_path), areas)
+            except (OSError, EOFError):
+                missing.append(name)
+                continue
+            if not keep.any():
+                # left out of the bundle
+                continue
+            # the zeroed blocks compress to almost nothing
+            member = GzipMember(0, int(member.size * keep.sum() / len(keep)), member.crc,
+                                (np.flatnonzero(keep)[-1] + 1) * IO_BLOCK_SIZE)
+        tiles.append(dict(name=name, size=int(member.isize), compressed_size=member.size))
+        entries.append((name, member))
+
+    return jsonify(version=version, tiles=tiles,
+                   outside=[fn[:-3] for fn in outside], missing=missing, generate=generate,
+                   size=sum(tile['size'] for tile in tiles),
+                   zip_size=zip_size(entries, stream_bundles))
+
+@app.route('/manifest', methods=['GET', 'POST'])
+@limiter.limit("600 per hour")
+def manifest():
+    '''List the tiles of a request with their sizes and ETags, for fetching individually from /tiles'''
+    try:
+        (areas, version) = parseAreas(request.values, request.files)
+        (filelist, outside) = getAreasFileList(areas, version)
+    except:
+        print("Bad data")
+        return jsonify(error="Error with input"), 400
+
+    (tile_path, url_path) = getTilePath(version)
+    tiles = []
+    missing = []
+    for (fn, entry) in zip(filelist, fetchTilesOrHeld(filelist, url_path)):
+        name = os.path.basename(fn)
+        if entry == None:
+            missing.append(name[:-3])
+            continue
+        # size and crc32 are of the .DAT on the SD card, etag of the download
+        etag = tileTag(entry)
+        tiles.append(dict(name=name[:-3], size=entry.member.isize, crc32=entry.member.crc,
+                          compressed_size=entry.size, etag=etag,
+                          url=url_for('tile', version=version, name=name, etag=etag)))
+
+    return jsonify(version=version, tiles=tiles,
+                   outside=[fn[:-3] for fn in outside], missing=missing)
+
+def tileHeld():
+    '''Whether the tile requested from /tiles is already held, so sending it
+    doesn't count against the rate limit'''
+    version = request.view_args['version']
+    if version not in spacings or tile_position(request.view_args['name']) == None:
+        return False
+    return getCatalog(getTilePath(version)[0]).get(request.view_args['name']) != None
+
+@app.route('/tiles/<int:version>/<name>')
+@limiter.limit(lambda: tile_fetch_limit, exempt_when=tileHeld)
+def tile(version, name):
+    '''Send a single .DAT.gz tile, cacheable by clients and proxies'''
+    position = tile_position(name)
+    if version not in spacings or position == None or not inDatabase(*position):
+        abort(404)
+    (tile_path, url_path) = getTilePath(version)
+    fn = os.path.join(tile_path, name)
+    try:
+        entry = fetchTile(fn, url_path)
+    except Exception:
+        entry = None
+    if entry == None:
+        abort(404)
+    etag = tileTag(entry)
+    response = send_file(fn, mimetype='application/gzip', conditional=True, etag=etag)
+    if request.args.get('etag') == etag:
+        # the URL changes with the tile, so it can be cached indefinitely
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, max-age=%u' % tile_max_age
+    return response
+
+@app.route('/altitude', methods=['POST'])
+@limiter.limit("600 per hour")
+def altitude():
+    '''Get the terrain altitudes of a batch of points, as AP_Terrain would interpolate them.
+    Takes JSON {"version": 3, "points": [[lat, lon], ...]}'''
+    try:
+        query = request.get_json(force=True)
+        version = int(query['version'])
+        assert version in spacings
+        points = np.array(query['points'], dtype=np.float64).reshape(-1, 2)
+        assert len(points) <= altitude_max_points
+        assert np.all(np.abs(points[:, 0]) < 90)
+        assert np.all(np.abs(points[:, 1]) < 180)
+    except:
+        print("Bad data")
+        return jsonify(error="Error with input"), 400
+
+    heights = terrain_query.altitudes(points[:, 0], points[:, 1], getSpacing(version),
+                                      lambda lat_int, lon_int: readTileAt(lat_int, lon_int, version))
+    return jsonify(version=version,
+                   altitudes=[None if math.isnan(height) else height for height in heights.tolist()])
+
+@app.route('/profile', methods=['POST'])
+@limiter.limit("600 per hour")
+def profile():
+    '''Get the terrain profile along a route, sampled every spacing metres, as
+    AP_Terrain would interpolate it. Takes JSON
+    {"version": 3, "points": [[lat, lon], ...], "spacing": 100}'''
+    try:
+        query = request.get_json(force=True)
+        version = int(query['version'])
+        assert version in spacings
+        points = np.array(query['points'], dtype=np.float64).reshape(-1, 2)
+        assert len(points) >= 1
+        assert np.all(np.abs(points[:, 0]) < 90)
+        assert np.all(np.abs(points[:, 1]) < 180)
+        spacing = float(query.get('spacing', getSpacing(version)))
+        assert math.isfinite(spacing) and spacing >= 1
+        # checked before the points are made, as a long route could need too many to hold
+        length = terrain_query.leg_lengths(points[:, 0], points[:, 1]).sum()
+        assert length / spacing + 2 <= profile_max_points
+        (distance, lat, lon) = terrain_query.densify(points[:, 0], points[:, 1], spacing)
+        assert len(distance) <= profile_max_points
+    except:
+        print("Bad data")
+        return jsonify(error="Error with input"), 400
+
+    # each tile is read once for the whole route, and each block paged in once
+    tiles = {}
+    def readTileOnce(lat_int, lon_int):
+        if (lat_int, lon_int) not in tiles:
+            tiles[(lat_int, lon_int)] = readTileAt(lat_int, lon_int, version)
+        return tiles[(lat_int, lon_int)]
+
+    heights = terrain_query.altitudes(lat, lon, getSpacing(version), readTileOnce)
+    return jsonify(version=version, spacing=spacing,
+                   distance=distance.tolist(), lat=lat.tolist(), lon=lon.tolist(),
+                   altitudes=[None if math.isnan(height) else height for height in heights.tolist()])
+
+@app.route('/metrics')
+@limiter.exempt
+def metricsReport():
+    return Response(metrics.render(metrics_path), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stream')
+def stream():
+    try:
+        (lat, lon, radius, version) = parseRequest(request.args)
+    except:
+        print("Bad data")
+        return render_template('generate.html', error="Error with input"), 400
+
+    print("Stream: %.9f %.9f %.3f version=%u" % (lat, lon, radius, version))
+
+    (filelist, outside) = getFileList(lat, lon, radius, version)
+    (tile_path, url_path) = getTilePath(version)
+    if url_path == None and not all(tileExists(fn) or canGenerate(fn) for fn in filelist):
+        print("Missing tiles for stream")
+        return render_template('generate.html', error="Cannot generate terrain"), 404
+
+    areas = [(lat, lon, radius)] if request.args.get('sparse') == '1' else None
+    return Response(stream_with_context(streamFiles(filelist, version, areas)), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=terrain.zip'})
+
+if catalog_at_start:
+    loadCatalogs()
+
 if __name__ == "__main__":
     app.run()
@@ -1,5 +1,6 @@
 import io
 import os
+import gzip
 import time
 import pytest
 import struct
@@ -19,13 +20,39 @@ def client():
     with app.test_client() as client:
         yield client
 
+def createTile(folder, name, blocks=16):
+    # create a .DAT.gz tile of compressible block data
+    from fast_gen import write_dat_gz
+    data = b''.join(struct.pack('<I', i) * 512 for i in range(blocks))
+    write_dat_gz(os.path.join(folder, name), name, data)
+    return data
+
+@pytest.fixture
+def local_tiles(tmp_path, monkeypatch):
+    """Serve tiles from a local folder instead of the terrain server"""
+    import app as terrain_app
+    for version in (1, 3, 6, 9):
+        tile_path = tmp_path / ("tilesdat%u" % version)
+        tile_path.mkdir()
+        monkeypatch.setattr(terrain_app, 'tile_path%u' % version, str(tile_path))
+        monkeypatch.setattr(terrain_app, 'url_path%u' % version, None)
+    output_path = tmp_path / 'userRequestTerrain'
+    monkeypatch.setattr(terrain_app, 'output_path', str(output_path))
+    monkeypatch.setattr(terrain_app, 'work_path', str(tmp_path / 'terrainWork'))
+    monkeypatch.setattr(terrain_app, 'job_path', str(tmp_path / 'terrainWork' / 'jobs'))
+    monkeypatch.setattr(terrain_app, 'index_path', str(tmp_path / 'terrainWork' / 'index.sqlite'))
+    monkeypatch.setattr(terrain_app, 'metrics_path', str(tmp_path / 'terrainWork' / 'metrics'))
+    monkeypatch.setattr(terrain_app, 'lock_path', str(tmp_path / 'terrainWork' / 'locks'))
+    monkeypatch.setattr(terrain_app, 'dat_cache_path', str(tmp_path / 'terrainWork' / 'datcache'))
+    return tmp_path
+
 def test_homepage(client):
     """Test that the homepage can be generated"""
 
     rv = client.get('/')
     # assert all the controls are there
     assert b'<title>ArduPilot Terrain Generator</title>' in rv.data
-    assert b'<form action="/generate" method="post">' in rv.data
+    assert b'<form action="/generate" method="post" enctype="multipart/form-data">' in rv.data
     assert b'<input type="text" id="lat" name="lat" value="-35.363261" oninput="plotCircleCoords(true);">' in rv.data
     assert b'<input type="text" id="long" name="long" value="149.165230" oninput="plotCircleCoords(true);">' in rv.data
     assert b'<input type="range" id="radius" name="radius" value="100" min="1" max="400"\n                oninput="plotCircleCoords(false);">' in rv.data
@@ -77,6 +104,486 @@ def test_badinput(client):
     assert b'Error' in rv.data
     assert b'download="terrain.zip"' not in rv.data
     
+def test_tile_selection():
+    """Test that the tile selection matches the per-km cell lattice"""
+    import math
+    from app import getTiles, getAreasTiles
+    from terrain_gen import add_offset
+
+    def lattice_tiles(lat, lon, radius):
+        tiles = []
+        for dx in range(-radius, radius):
+            for dy in range(-radius, radius):
+                (lat2, lon2) = add_offset(lat*1e7, lon*1e7, dx*1000.0, dy*1000.0, "4.1")
+                tag = (int(math.floor(lat2 * 1.0e-7)), int(math.floor(lon2 * 1.0e-7)))
+                if tag not in tiles:
+                    tiles.append(tag)
+        return tiles
+
+    for (lat, lon, radius) in [(-35.363261, 149.165230, 1),
+                               (60.363261, 167.165230, 37),
+                               (-83.363261, 149.165230, 100),
+                               (83.9, -179.95, 120),
+                               (0.01, -0.01, 60)]:
+        assert getTiles(lat, lon, radius) == lattice_tiles(lat, lon, radius)
+
+    # and for several areas at once, each tile once
+    areas = [(-35.363261, 149.165230, 1), (-35.2, 149.8, 40), (0.01, -0.01, 60), (-35.3, 149.9, 20)]
+    expected = []
+    for (lat, lon, radius) in areas:
+        expected += [tile for tile in lattice_tiles(lat, lon, radius) if tile not in expected]
+    assert list(getAreasTiles(areas)) == expected
+
+@pytest.fixture
+def tile_server(tmp_path):
+    """Serve a folder of tiles over HTTP, counting requests and connections"""
+    import functools
+    import threading
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            self.server.connections += 1
+
+        def do_GET(self):
+            self.server.requests.append(self.path)
+            time.sleep(0.05)
+            super().do_GET()
+
+        def log_message(self, format, *args):
+            pass
+
+    folder = tmp_path / 'server'
+    folder.mkdir()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=str(folder)))
+    server.folder = folder
+    server.url = 'http://127.0.0.1:%u/tiles/' % server.server_address[1]
+    (folder / 'tiles').mkdir()
+    server.requests = []
+    server.connections = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_tile_fetch(tmp_path, tile_server):
+    """Test fetching tiles from a terrain server into a local cache"""
+    import concurrent.futures
+    from tile_fetch import TileFetcher
+
+    names = ['S36E%03u.DAT.gz' % lon for lon in range(140, 148)]
+    tiles = {}
+    for name in names:
+        tiles[name] = createTile(str(tile_server.folder / 'tiles'), name)
+    cache = tmp_path / 'cache'
+    fetcher = TileFetcher(tile_server.url, str(cache), max_workers=2)
+
+    # concurrent requests for the same tiles share downloads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(fetcher.fetch_many, names) for i in range(4)]
+        for future in futures:
+            for f in future.result():
+                f.result()
+    assert sorted(tile_server.requests) == sorted('/tiles/' + name for name in names)
+    # and reuse connections
+    assert tile_server.connections <= 2
+    assert set(os.listdir(str(cache))) == set(names)
+    for name in names:
+        with gzip.open(str(cache / name)) as f:
+            assert f.read() == tiles[name]
+
+    # cached tiles aren't downloaded again
+    fetcher.fetch(names[0]).result()
+    assert len(tile_server.requests) == len(names)
+
+    # missing tiles are an error, and leave nothing behind
+    with pytest.raises(IOError):
+        fetcher.fetch('S36E149.DAT.gz').result()
+    assert set(os.listdir(str(cache))) == set(names)
+
+def test_remotegen(client, local_tiles, tile_server, monkeypatch):
+    """Test that a bundle is generated from tiles fetched from a terrain server"""
+    import app as terrain_app
+    monkeypatch.setattr(terrain_app, 'url_path3', tile_server.url)
+    for lon in [149, 150]:
+        createTile(str(tile_server.folder / 'tiles'), 'S36E%03u.DAT.gz' % lon)
+
+    rv = client.post('/generate', data=dict(
+        lat='-35.5',
+        long='149.995',
+        radius='2',
+        version="3"
+    ), follow_redirects=True)
+    assert b'download="terrain.zip"' in rv.data
+    assert sorted(os.listdir(str(local_tiles / 'tilesdat3'))) == ['S36E149.DAT.gz', 'S36E150.DAT.gz']
+
+def test_remotegen_failure(client, local_tiles, tile_server, monkeypatch):
+    """Test that a bundle stops fetching tiles at the first which fails"""
+    import app as terrain_app
+    monkeypatch.setattr(terrain_app, 'url_path3', tile_server.url)
+
+    rv = client.post('/generate', data=dict(
+        lat='-35.5',
+        long='149.995',
+        radius='200',
+        version="3"
+    ), follow_redirects=True)
+    assert b'Cannot generate terrain' in rv.data
+    # only the tiles read ahead of the failure are downloaded, and only once
+    time.sleep(0.5)
+    assert len(tile_server.requests) <= 2 * terrain_app.tile_workers
+    assert len(set(tile_server.requests)) == len(tile_server.requests)
+
+def test_zip_from_gzip(tmp_path):
+    """Test that tiles are spliced into a zip without recompression"""
+    from terrain_zip import ZipWriter
+
+    tiles = {}
+    for name in ['S36E149.DAT.gz', 'S36E150.DAT.gz']:
+        tiles[name[:-3]] = createTile(str(tmp_path), name)
+    # a tile with no name in its gzip header
+    with gzip.GzipFile(str(tmp_path / 'S37E149.DAT.gz'), 'wb') as f:
+        tiles['S37E149.DAT'] = os.urandom(4096)
+        f.write(tiles['S37E149.DAT'])
+
+    def build(f_out):
+        with ZipWriter(f_out) as terrain_zip:
+            for name in sorted(tiles):
+                terrain_zip.add_gzip(name, str(tmp_path / (name + '.gz')))
+
+    zips = []
+    for buffering in [0, -1]:
+        with open(str(tmp_path / 'terrain.zip'), 'wb', buffering=buffering) as f_out:
+            build(f_out)
+        with open(str(tmp_path / 'terrain.zip'), 'rb') as f:
+            zips.append(f.read())
+    f_out = io.BytesIO()
+    build(f_out)
+    zips.append(f_out.getvalue())
+
+    for zipdata in zips:
+        with zipfile.ZipFile(io.BytesIO(zipdata)) as zip_file:
+            assert zip_file.testzip() is None
+            assert zip_file.namelist() == sorted(tiles)
+            for name in tiles:
+                assert zip_file.read(name) == tiles[name]
+
+def test_localgen(client, local_tiles):
+    """Test that a bundle is generated from the local tile database"""
+    data = createTile(str(local_tiles / 'tilesdat3'), 'S36E149.DAT.gz')
+
+    rv = client.post('/generate', data=dict(
+        lat='-35.363261',
+        long='149.165230',
+        radius='1',
+        version="3"
+    ), follow_redirects=True)
+
+    assert b'Error' not in rv.data
+    assert b'download="terrain.zip"' in rv.data
+    uuidkey = (rv.data.split(b"footer")[1][1:-2]).decode("utf-8")
+
+    rdown = client.get('/userRequestTerrain/' + uuidkey + ".zip", follow_redirects=True)
+    assert rdown.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(rdown.data)) as zip_file:
+        assert zip_file.namelist() == ['S36E149.DAT']
+        assert zip_file.read('S36E149.DAT') == data
+
+def test_bundle_reuse(client, local_tiles, monkeypatch):
+    """Test that requests for the same tiles share one bundle"""
+    for lon in [149, 150]:
+        createTile(str(local_tiles / 'tilesdat3'), 'S36E%03u.DAT.gz' % lon)
+
+    uuidkeys = []
+    for lon in ['149.3', '149.4', '150.5']:
+        rv = client.post('/generate', data=dict(
+            lat='-35.5',
+            long=lon,
+            radius='1',
+            version="3"
+        ), follow_redirects=True)
+        assert b'download="terrain.zip"' in rv.data
+        uuidkeys.append((rv.data.split(b"footer")[1][1:-2]).decode("utf-8"))
+
+    output_path = local_tiles / 'userRequestTerrain'
+    inodes = [os.stat(str(output_path / (uuidkey + '.zip'))).st_ino for uuidkey in uuidkeys]
+    assert inodes[0] == inodes[1]
+    assert inodes[0] != inodes[2]
+    assert len([f for f in os.listdir(str(output_path)) if f.startswith('bundle-')]) == 2
+
+    # a regenerated tile isn't served from the old bundle
+    import app as terrain_app
+    data = createTile(str(local_tiles / 'tilesdat3'), 'S36E149.DAT.gz', blocks=8)
+    terrain_app.getCatalog(str(local_tiles / 'tilesdat3')).refresh(force=True)
+    rv = client.post('/generate', data=dict(lat='-35.5', long='149.3', radius='1', version="3"))
+    uuidkey = (rv.data.split(b"footer")[1][1:-2]).decode("utf-8")
+    with zipfile.ZipFile(str(output_path / (uuidkey + '.zip'))) as zf:
+        assert zf.read('S36E149.DAT') == data
+    assert len([f for f in os.listdir(str(output_path)) if f.startswith('bundle-')]) == 3
+
+    # a bundle swept away just after it was linked still leaves the request its file
+    linkBundle = terrain_app.linkBundle
+    def linkAndSweep(bundle, zipthis):
+        linkBundle(bundle, zipthis)
+        os.remove(bundle)
+    monkeypatch.setattr(terrain_app, 'linkBundle', linkAndSweep)
+    rv = client.post('/generate', data=dict(lat='-35.5', long='149.3', radius='1', version="3"))
+    assert b'download="terrain.zip"' in rv.data
+    uuidkey = (rv.data.split(b"footer")[1][1:-2]).decode("utf-8")
+    assert client.get('/userRequestTerrain/' + uuidkey + '.zip').status_code == 200
+
+def test_single_flight(local_tiles, monkeypatch):
+    """Test that concurrent requests for the same tiles wait for one build"""
+    import concurrent.futures
+    import app as terrain_app
+    createTile(str(local_tiles / 'tilesdat3'), 'S36E149.DAT.gz')
+
+    builds = []
+    compressFiles = terrain_app.compressFiles
+    def slowCompress(*args):
+        builds.append(args)
+        time.sleep(0.2)
+        return compressFiles(*args)
+    monkeypatch.setattr(terrain_app, 'compressFiles', slowCompress)
+
+    (filelist, outside) = terrain_app.getFileList(-35.5, 149.3, 1, 3)
+    uuidkeys = ['request%u' % i for i in range(6)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as pool:
+        results = list(pool.map(lambda uuidkey: terrain_app.generateBundle(filelist, uuidkey, 3), uuidkeys))
+    assert results == [True] * 6
+    assert len(builds) == 1
+
+    output_path = local_tiles / 'userRequestTerrain'
+    inodes = set(os.stat(str(output_path / (uuidkey + '.zip'))).st_ino for uuidkey in uuidkeys)
+    assert len(inodes) == 1
+
+def test_sweeper(client, local_tiles):
+    """Test that generated files are expired using the index"""
+    import app as terrain_app
+    createTile(str(local_tiles / 'tilesdat3'), 'S36E149.DAT.gz')
+    output_path = local_tiles / 'userRequestTerrain'
+
+    uuidkeys = []
+    for lon in ['149.3', '149.4']:
+        rv = client.post('/generate', data=dict(
+            lat='-35.5',
+            long=lon,
+            radius='1',
+            version="3"
+        ), follow_redirects=True)
+        uuidkeys.append((rv.data.split(b"footer")[1][1:-2]).decode("utf-8"))
+    bundles = [f for f in os.listdir(str(output_path)) if f.startswith('bundle-')]
+    assert len(os.listdir(str(output_path))) == 3
+
+    # a file left behind by a crash is adopted using its modification time
+    leftover = output_path / 'leftover.tmp'
+    leftover.write_bytes(b'')
+    os.utime(str(leftover), (time.time() - 25 * 60 * 60,) * 2)
+
+    index = terrain_app.getFileIndex()
+    index.add(str(output_path / (uuidkeys[0] + '.zip')), time.time() - 25 * 60 * 60)
+    assert index.adopt(str(output_path)) == 4
+    assert index.sweep(24 * 60 * 60, batch_size=1) == 2
+    assert sorted(os.listdir(str(output_path))) == sorted([uuidkeys[1] + '.zip'] + bundles)
+
+    # the second request's download survives its bundle being expired
+    for f in os.listdir(str(output_path)):
+        index.add(str(output_path / f), time.time() - (24 * 60 * 60 if f.startswith('bundle-') else 60) - 1)
+    assert index.sweep(24 * 60 * 60) == 1
+    with zipfile.ZipFile(str(output_path / (uuidkeys[1] + '.zip'))) as zip_file:
+        assert zip_file.namelist() == ['S36E149.DAT']
+
+def test_plan(client, local_tiles):
+    """Test that the tiles and size of a request are reported without generating it"""
+    tiles = {}
+    for lon in range(141, 158):
+        for lat in [83, 84]:
+            name = 'S%02uE%03u.DAT' % (lat, lon)
+            tiles[name] = len(createTile(str(local_tiles / 'tilesdat3'), name + '.gz', blocks=lon - 140))
+    os.remove(str(local_tiles / 'tilesdat3' / 'S84E150.DAT.gz'))
+    del tiles['S84E150.DAT']
+    request = dict(lat='-83.363261', long='149.165230', radius='100', version="3")
+
+    rv = client.get('/plan', query_string=request)
+    assert rv.status_code == 200
+    plan = rv.get_json()
+    assert plan['missing'] == ['S84E150.DAT']
+    assert len(plan['tiles']) == 32
+    for tile in plan['tiles']:
+        assert tile['size'] == tiles[tile['name']]
+    assert plan['size'] == sum(tile['size'] for tile in plan['tiles'])
+    assert len(plan['outside']) > 0
+    assert 'S85E149.DAT' in plan['outside']
+    assert not os.path.exists(str(local_tiles / 'userRequestTerrain'))
+
+    # the zip size is exact
+    createTile(str(local_tiles / 'tilesdat3'), 'S84E150.DAT.gz', blocks=10)
+    plan = client.post('/plan', data=request).get_json()
+    assert plan['missing'] == []
+    rv = client.post('/generate', data=request)
+    uuidkey = (rv.data.split(b"footer")[1][1:-2]).decode("utf-8")
+    assert os.path.getsize(str(local_tiles / 'userRequestTerrain' / (uuidkey + '.zip'))) == plan['zip_size']
+
+    assert client.get('/plan', query_string=dict(lat='bad')).status_code == 400
+
+def test_metrics(client, local_tiles):
+    """Test that metrics are reported in the Prometheus format, totalled over processes"""
+    import json
+    createTile(str(local_tiles / 'tilesdat3'), 'S36E149.DAT.gz')
+
+    def report():
+        rv = client.get('/metrics')
+        assert rv.status_code == 200
+        assert rv.mimetype == 'text/plain'
+        return dict(line.rsplit(' ', 1) for line in rv.data.decode('utf-8').splitlines()
+                    if not line.startswith('#'))
+
+    before = report()
+    for i in range(2):
+        client.post('/generate', data=dict(lat='-35.5', long='149.3', radius='1', version="3"))
+    after = report()
+    assert int(after['terraingen_generate_requests_total']) == int(before['terraingen_generate_requests_total']) + 2
+    assert int(after['terraingen_bundle_cache_misses_total']) == int(before['terraingen_bundle_cache_misses_total']) + 1
+    assert int(after['terraingen_bundle_cache_hits_total']) == int(before['terraingen_bundle_cache_hits_total']) + 1
+    assert int(after['terraingen_tile_selection_seconds_count']) == int(before['terraingen_tile_selection_seconds_count']) + 2
+    assert int(after['terraingen_bundle_bytes_bucket{le="+Inf"}']) == int(after['terraingen_bundle_bytes_count'])
+    assert int(after['terraingen_bundle_bytes_bucket{le="262144"}']) == int(before['terraingen_bundle_bytes_bucket{le="262144"}']) + 1
+
+    # another process's metrics are included
+    with open(str(local_tiles / 'terrainWork' / 'metrics' / '1-1.json'), 'w') as f:
+        json.dump(dict(counters=dict(terraingen_generate_requests_total=5), histograms={}), f)
+    assert int(report()['terraingen_generate_requests_total']) == int(after['terraingen_generate_requests_total']) + 5
+
+    # the files of exited processes are merged, keeping the totals
+    import subprocess
+    import sys
+    import metrics
+    folder = local_tiles / 'terrainWork' / 'metrics'
+    exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+    exited.wait()
+    for name in ['%u-1.json' % exited.pid, '%u-2.json' % exited.pid]:
+        with open(str(folder / name), 'w') as f:
+            json.dump(dict(counters=dict(terraingen_generate_requests_total=3), histograms={}), f)
+    assert metrics.retire(str(folder)) == 2
+    assert metrics.retire(str(folder)) == 0
+    assert 'retired.json' in os.listdir(str(folder))
+    assert len([f for f in os.listdir(str(folder)) if f.endswith('.json')]) == 3
+    assert int(report()['terraingen_generate_requests_total']) == int(after['terraingen_generate_requests_total']) + 11
+
+def test_streamgen(client, local_tiles, monkeypatch):
+    """Test that a bundle can be streamed instead of stored"""
+    import html
+    import app as terrain_app
+    monkeypatch.setattr(terrain_app, 'stream_bundles', True)
+    tiles = {}
+    for lon in [149, 150]:
+        tiles['S36E%03u.DAT' % lon] = createTile(str(local_tiles / 'tilesdat3'), 'S36E%03u.DAT.gz' % lon)
+
+    rv = client.post('/generate', data=dict(
+        lat='-35.5',
+        long='149.995',
+        radius='2',
+        version="3"
+    ), follow_redirects=True)
+    assert b'Error' not in rv.data
+    assert b'download="terrain.zip"' in rv.data
+    urlkey = html.unescape(rv.data.split(b'href="')[1].split(b'"')[0].decode("utf-8"))
+    assert not os.path.exists(str(local_tiles / 'userRequestTerrain'))
+
+    rdown = client.get(urlkey)
+    assert rdown.status_code == 200
+    assert rdown.is_streamed
+    with zipfile.ZipFile(io.BytesIO(rdown.data)) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == sorted(tiles)
+        for info in zip_file.infolist():
+            assert info.flag_bits & 0x08
+            assert zip_file.read(info) == tiles[info.filename]
+
+    # missing tiles are reported before streaming starts
+    rv = client.get(urlkey.replace('149.995', '151.5'))
+    assert rv.status_code == 404
+
+def test_asyncgen(client, local_tiles, monkeypatch):
+    """Test that large requests are generated by a background job"""
+    import app as terrain_app
+    monkeypatch.setattr(terrain_app, 'async_tiles', 2)
+    for lon in [149, 150]:
+        createTile(str(local_tiles / 'tilesdat3'), 'S36E%03u.DAT.gz' % lon)
+
+    rv = client.post('/generate', data=dict(
+        lat='-35.5',
+        long='149.995',
+        radius='2',
+        version="3"
+    ), follow_redirects=True)
+    assert b'Error' not in rv.data
+    assert b'in progress' in rv.data
+    uuidkey = (rv.data.split(b"footer")[1][1:-2]).decode("utf-8")
+
+    # a request of fewer tiles, even with a larger radius, is generated immediately
+    rv = client.post('/generate', data=dict(lat='-35.5', long='149.5', radius='5', version="3"))
+    assert b'download="terrain.zip"' in rv.data
+    assert b'in progress' not in rv.data
+
+    for i in range(100):
+        status = client.get('/status/' + uuidkey).get_json()
+        if status['state'] == 'done':
+            break
+        time.sleep(0.1)
+    assert status['state'] == 'done'
+    assert status['tiles_done'] == status['tiles_total'] == 2
+
+    rdown = client.get(status['url'])
+    assert rdown.status_code == 200
+    assert len(rdown.data) == status['bytes_written']
+    with zipfile.ZipFile(io.BytesIO(rdown.data)) as zip_file:
+        assert zip_file.namelist() == ['S36E149.DAT', 'S36E150.DAT']
+
+    assert client.get('/status/not-a-uuid').status_code == 404
+    assert client.get('/status/4a2b1c6e-0000-11f1-a5d2-02fc00000001').status_code == 404
+
+    # polling isn't rate limited
+    for i in range(60):
+        assert client.get('/status/' + uuidkey).status_code == 200
+
+    # a job whose app process has gone is reported as failed
+    lost = '4a2b1c6e-0000-11f1-a5d2-02fc00000002'
+    terrain_app.writeJobStatus(lost, 'running', 1, 2, 0)
+    assert client.get('/status/' + lost).get_json()['state'] == 'running'
+    os.utime(os.path.join(terrain_app.job_path, lost + '.json'), (1, 1))
+    assert client.get('/status/' + lost).get_json()['state'] == 'failed'
+
+def test_tile_order(client, local_tiles, monkeypatch):
+    """Test that tiles opened in parallel are zipped in order"""
+    import random
+    import app as terrain_app
+
+    fetchTile = terrain_app.fetchTile
+    def slowFetch(fn, url_path):
+        time.sleep(random.uniform(0, 0.05))
+        fetchTile(fn, url_path)
+    monkeypatch.setattr(terrain_app, 'fetchTile', slowFetch)
+
+    for lat in [-36, -35]:
+        for lon in range(147, 152):
+            createTile(str(local_tiles / 'tilesdat3'), terrain_app.getDatFile(lat, lon))
+    (filelist, outsideLat) = terrain_app.getFileList(-35.0, 149.5, 100, 3)
+    assert len(filelist) == 6
+
+    zipthis = str(local_tiles / 'terrain.zip')
+    assert terrain_app.compressFiles(filelist, zipthis, 3)
+    with zipfile.ZipFile(zipthis) as zip_file:
+        assert zip_file.namelist() == [os.path.basename(fn)[:-3] for fn in filelist]
+
+    # a missing tile fails the bundle
+    os.remove(filelist[4])
+    assert not terrain_app.compressFiles(filelist, zipthis, 3)
+
 def test_simplegen_1(client):
     """Test that a small piece of terrain can be generated, SRTM1"""
 
@@ -355,3 +862,583 @@ def test_terrain_gen_coastal_bug():
 
     finally:
         shutil.rmtree(temp_dir)
+
+def test_dat_cache(local_tiles):
+    """Test that decompressed tiles are cached, shared and evicted least recently used first"""
+    import app as terrain_app
+    from dat_cache import DatCache
+    tile_path = str(local_tiles / 'tilesdat3')
+    tiles = {}
+    for lon in [149, 150, 151]:
+        tiles[lon] = createTile(tile_path, 'S36E%03u.DAT.gz' % lon)
+    fn = os.path.join(tile_path, 'S36E149.DAT.gz')
+
+    (hits, misses) = [terrain_app.metrics.counters['terraingen_dat_cache_%s_total' % name]
+                      for name in ('hits', 'misses')]
+    assert terrain_app.readTile(fn, None)[:] == tiles[149]
+    assert terrain_app.readTile(fn, None)[:] == tiles[149]
+    assert terrain_app.metrics.counters['terraingen_dat_cache_misses_total'] == misses + 1
+    assert terrain_app.metrics.counters['terraingen_dat_cache_hits_total'] == hits + 1
+
+    # another process's cache shares the decompressed copy
+    cache = DatCache(terrain_app.dat_cache_path, 2 * len(tiles[149]))
+    path = cache.cache_path(fn)
+    assert os.path.exists(path)
+    assert cache.get(fn)[:] == tiles[149]
+
+    # adding a third tile evicts the least recently used
+    cache.get(os.path.join(tile_path, 'S36E150.DAT.gz'))
+    os.utime(path, (1, 1))
+    assert cache.get(os.path.join(tile_path, 'S36E151.DAT.gz'))[:] == tiles[151]
+    assert not os.path.exists(path)
+    assert cache.get(fn)[:] == tiles[149]
+
+def test_download_resume(client, local_tiles, monkeypatch):
+    """Test that bundles are sent with strong ETags and support ranges and conditional requests"""
+    for lon in [149, 150]:
+        createTile(str(local_tiles / 'tilesdat3'), 'S36E%03u.DAT.gz' % lon)
+
+    uuidkeys = []
+    for lon in ['149.3', '149.3', '150.5']:
+        rv = client.post('/generate', data=dict(lat='-35.5', long=lon, radius='1', version="3"))
+        uuidkeys.append(rv.data.split(b"footer")[1][1:-2].decode("utf-8"))
+    url = '/userRequestTerrain/' + uuidkeys[0] + '.zip'
+    rdown = client.get(url)
+    assert rdown.status_code == 200
+    etag = rdown.headers['ETag']
+    assert not etag.startswith('W/')
+    assert rdown.headers['Accept-Ranges'] == 'bytes'
+
+    # the same tiles have the same ETag, other tiles don't
+    assert client.get('/userRequestTerrain/' + uuidkeys[1] + '.zip').headers['ETag'] == etag
+    assert client.get('/userRequestTerrain/' + uuidkeys[2] + '.zip').headers['ETag'] != etag
+
+    rv = client.get(url, headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.data == b''
+
+    rv = client.get(url, headers={'Range': 'bytes=100-', 'If-Range': etag})
+    assert rv.status_code == 206
+    assert rv.data == rdown.data[100:]
+    assert rv.headers['Content-Range'] == 'bytes 100-%u/%u' % (len(rdown.data) - 1, len(rdown.data))
+
+    # a changed bundle is sent in full
+    rv = client.get(url, headers={'Range': 'bytes=100-', 'If-Range': '"changed"'})
+    assert rv.status_code == 200
+    assert rv.data == rdown.data
+
+    assert client.get('/userRequestTerrain/missing.zip').status_code == 404
+    assert client.get('/userRequestTerrain/..%2Fapp.py').status_code == 404
+
+    # a bundle rebuilt at another time has the same ETag
+    import terrain_zip
+    output_path = local_tiles / 'userRequestTerrain'
+    for name in os.listdir(str(output_path)):
+        if name.startswith('bundle-'):
+            os.remove(str(output_path / name))
+    monkeypatch.setattr(terrain_zip, 'dos_datetime', lambda t: (0, 33))
+    rv = client.post('/generate', data=dict(lat='-35.5', long='149.3', radius='1', version="3"))
+    rebuilt = client.get('/userRequestTerrain/' + rv.data.split(b"footer")[1][1:-2].decode("utf-8") + '.zip')
+    assert rebuilt.data != rdown.data
+    assert rebuilt.headers['ETag'] == etag
+
+def test_sparsegen(client, local_tiles):
+    """Test that a sparse bundle only includes the blocks within the radius"""
+    import io
+    import zipfile
+    import numpy as np
+    import fast_gen
+    from terrain_gen import IO_BLOCK_SIZE, get_distance_NE_e7
+    (blocks, stride) = fast_gen.enumerate_valid_blocks(-36, 149, 100, "4.1")
+    heights = np.zeros((len(blocks), 28, 32), dtype=np.int16)
+    data = fast_gen.pack_dat_file(blocks, heights, -36, 149, 100, "4.1")
+    fast_gen.write_dat_gz(str(local_tiles / 'tilesdat3' / 'S36E149.DAT.gz'), 'S36E149.DAT.gz', data)
+
+    def download(**params):
+        rv = client.post('/generate', data=dict(lat='-35.5', long='149.5', radius='5', version="3", **params))
+        uuidkey = rv.data.split(b"footer")[1][1:-2].decode("utf-8")
+        rdown = client.get('/userRequestTerrain/' + uuidkey + ".zip")
+        return rdown.data
+
+    full = download()
+    sparse = download(sparse='1')
+    assert len(sparse) * 10 < len(full)
+    assert zipfile.ZipFile(io.BytesIO(full)).read('S36E149.DAT') == data
+    tile = zipfile.ZipFile(io.BytesIO(sparse)).read('S36E149.DAT')
+    assert len(tile) <= len(data)
+    assert len(tile) % IO_BLOCK_SIZE == 0
+
+    # the plan of a sparse request has the sizes of its sparse tiles
+    request = dict(lat='-35.5', long='149.5', radius='5', version="3")
+    plan = client.get('/plan', query_string=request).get_json()
+    sparse_plan = client.get('/plan', query_string=dict(request, sparse='1')).get_json()
+    assert plan['size'] == len(data)
+    assert sparse_plan['size'] == len(tile)
+    assert sparse_plan['zip_size'] < plan['zip_size']
+
+    kept = 0
+    for (blocknum, grid_idx_x, grid_idx_y, lat_e7, lon_e7) in blocks:
+        block = tile[blocknum * IO_BLOCK_SIZE:(blocknum + 1) * IO_BLOCK_SIZE]
+        (north, east) = get_distance_NE_e7(-355000000, 1495000000, lat_e7, lon_e7, "4.1")
+        if block == data[blocknum * IO_BLOCK_SIZE:(blocknum + 1) * IO_BLOCK_SIZE]:
+            kept += 1
+            # within the radius and margin, allowing for the size of the block
+            assert (north**2 + east**2)**0.5 < 6000 + 4300
+        else:
+            assert block.strip(b'\0') == b''
+            # blocks containing the centre are always kept
+            assert not (-2700 < north <= 0 and -3100 < east <= 0)
+    assert 4 <= kept < len(blocks) / 10
+
+def test_load_test():
+    """Test that the load test harness runs against its stand-in tile server"""
+    import load_test
+    # memory used before the run isn't counted in its peak, so a ballast
+    # allocated and freed beforehand doesn't show up in it
+    ballast = b"x" * (256 * 1024 * 1024)
+    del ballast
+    results = load_test.run(requests=6, concurrency=3, radii=[1, 20], versions=[1, 3], blocks=16)
+    assert results['failures'] == 0
+    assert results['bytes_written'] > 0
+    assert results['tile_requests'] > 0
+    assert 0 < results['latency_p50'] <= results['latency_p99']
+    # None where the peak RSS can't be measured
+    if results['peak_rss_kb'] is not None:
+        assert 0 < results['peak_rss_kb'] < 256 * 1024
+
+def test_store_quota(client, local_tiles, monkeypatch):
+    """Test that the least recently downloaded bundles are removed once over the quota"""
+    import app as terrain_app
+    for lon in [149, 150, 151]:
+        createTile(str(local_tiles / 'tilesdat3'), 'S36E%03u.DAT.gz' % lon, blocks=64)
+    output_path = local_tiles / 'userRequestTerrain'
+
+    uuidkeys = []
+    for lon in ['149.3', '150.5', '151.5', '149.4']:
+        rv = client.post('/generate', data=dict(lat='-35.5', long=lon, radius='1', version="3"))
+        uuidkeys.append(rv.data.split(b"footer")[1][1:-2].decode("utf-8"))
+    size = os.path.getsize(str(output_path / (uuidkeys[0] + '.zip')))
+    store = terrain_app.getFileStore()
+    # hard links to a bundle are only counted once
+    assert store.size() == 3 * size
+
+    # nothing is removed within the minimum lifetime
+    monkeypatch.setattr(terrain_app, 'store_quota', 2 * size)
+    store = terrain_app.getFileStore()
+    assert store.sweep() == 0
+
+    # the first bundle was downloaded most recently, so the second is removed
+    monkeypatch.setattr(terrain_app, 'store_min_age', 0)
+    store = terrain_app.getFileStore()
+    db = store.db()
+    db.execute('UPDATE store SET created = created - 10, used = used - 10')
+    assert client.get('/userRequestTerrain/' + uuidkeys[3] + '.zip').status_code == 200
+    assert store.sweep() == 2
+    assert not os.path.exists(str(output_path / (uuidkeys[1] + '.zip')))
+    assert os.path.exists(str(output_path / (uuidkeys[0] + '.zip')))
+    assert os.path.exists(str(output_path / (uuidkeys[2] + '.zip')))
+    assert store.size() == 2 * size
+    assert store.sweep() == 0
+
+def createTerrainTile(folder, lat_int, lon_int, spacing=100):
+    # create a .DAT.gz tile with real block geometry and varied heights
+    import numpy as np
+    import fast_gen
+    (blocks, stride) = fast_gen.enumerate_valid_blocks(lat_int, lon_int, spacing, "4.1")
+    heights = np.zeros((len(blocks), 28, 32), dtype=np.int16)
+    for (i, block) in enumerate(blocks):
+        (gx, gy) = np.meshgrid(np.arange(28), np.arange(32), indexing='ij')
+        heights[i] = (block[1] * 24 + gx) * 3 + (block[2] * 28 + gy) * 7 % 1000
+    data = fast_gen.pack_dat_file(blocks, heights, lat_int, lon_int, spacing, "4.1")
+    name = fast_gen.dat_filename(lat_int, lon_int)
+    fast_gen.write_dat_gz(os.path.join(folder, name), name, data)
+    return data
+
+def refAltitude(data, lat, lon, spacing=100):
+    # AP_Terrain's interpolation of a point, one at a time
+    import math
+    from terrain_gen import (get_distance_NE_e7, east_blocks, IO_BLOCK_SIZE)
+    (tile_lat, tile_lon) = (math.floor(lat), math.floor(lon))
+    (ref_lat, ref_lon) = (tile_lat * 10**7, tile_lon * 10**7)
+    (north, east) = get_distance_NE_e7(ref_lat, ref_lon, int(lat * 1e7), int(lon * 1e7), "4.1")
+    (idx_x, idx_y) = (int(north / spacing), int(east / spacing))
+    blocknum = east_blocks(ref_lat, ref_lon, spacing, "4.1") * (idx_x // 24) + idx_y // 28
+    (local_x, local_y) = (idx_x % 24, idx_y % 28)
+    (frac_x, frac_y) = ((north - idx_x * spacing) / spacing, (east - idx_y * spacing) / spacing)
+    block = data[blocknum * IO_BLOCK_SIZE:(blocknum + 1) * IO_BLOCK_SIZE]
+    assert struct.unpack('<HH', block[1814:1818]) == (idx_x // 24, idx_y // 28)
+    def height(x, y):
+        return struct.unpack_from('<h', block, 22 + 2 * (x * 32 + y))[0]
+    avg1 = (1 - frac_x) * height(local_x, local_y) + frac_x * height(local_x + 1, local_y)
+    avg2 = (1 - frac_x) * height(local_x, local_y + 1) + frac_x * height(local_x + 1, local_y + 1)
+    return (1 - frac_y) * avg1 + frac_y * avg2
+
+def test_altitude(client, local_tiles):
+    """Test that a batch of altitudes are interpolated as AP_Terrain does"""
+    import random
+    data = createTerrainTile(str(local_tiles / 'tilesdat3'), -36, 149)
+    rng = random.Random(1)
+    points = [[rng.uniform(-35.999, -35.001), rng.uniform(149.001, 149.999)] for i in range(1000)]
+    # outside the database, and a missing tile
+    points += [[-85.5, 149.5], [-35.5, 150.5]]
+
+    rv = client.post('/altitude', json=dict(version=3, points=points))
+    assert rv.status_code == 200
+    altitudes = rv.get_json()['altitudes']
+    assert len(altitudes) == len(points)
+    for ((lat, lon), altitude) in zip(points[:1000], altitudes):
+        assert abs(altitude - refAltitude(data, lat, lon)) < 1e-6
+    assert altitudes[1000:] == [None, None]
+
+    assert client.post('/altitude', json=dict(version=2, points=points)).status_code == 400
+    assert client.post('/altitude', json=dict(version=3, points=[[91, 0]])).status_code == 400
+    assert client.post('/altitude', data='nonsense').status_code == 400
+
+def test_profile(client, local_tiles, monkeypatch):
+    """Test that a profile is sampled along a route and interpolated as AP_Terrain does"""
+    data = createTerrainTile(str(local_tiles / 'tilesdat3'), -36, 149)
+    route = [[-35.9, 149.1], [-35.9, 149.5], [-35.2, 149.5], [-35.2, 150.5]]
+
+    rv = client.post('/profile', json=dict(version=3, points=route, spacing=250))
+    assert rv.status_code == 200
+    profile = rv.get_json()
+    assert profile['distance'][0] == 0
+    assert (profile['lat'][0], profile['lon'][0]) == tuple(route[0])
+    assert (profile['lat'][-1], profile['lon'][-1]) == tuple(route[-1])
+    steps = [b - a for (a, b) in zip(profile['distance'], profile['distance'][1:])]
+    assert all(abs(step - 250) < 1e-6 for step in steps[:-1])
+    # about 36 + 78 + 90 km
+    assert 200000 < profile['distance'][-1] < 210000
+
+    altitudes = list(zip(profile['lat'], profile['lon'], profile['altitudes']))
+    for (lat, lon, altitude) in altitudes:
+        if lon < 150:
+            assert abs(altitude - refAltitude(data, lat, lon)) < 1e-6
+        else:
+            # no tile here
+            assert altitude is None
+
+    # the default spacing is the grid spacing
+    rv = client.post('/profile', json=dict(version=3, points=route[:2]))
+    assert len(rv.get_json()['distance']) == 362
+    assert client.post('/profile', json=dict(version=3, points=route, spacing=0)).status_code == 400
+    assert client.post('/profile', json=dict(version=3, points=[])).status_code == 400
+    rv = client.post('/profile', data='{"version": 3, "points": [[-35, 149], [-36, 150]], "spacing": Infinity}',
+                     content_type='application/json')
+    assert rv.status_code == 400
+    # routes too long for the spacing are refused before their points are made
+    import terrain_query
+    densified = []
+    monkeypatch.setattr(terrain_query, 'densify', lambda *args: densified.append(args))
+    rv = client.post('/profile', json=dict(version=3, points=[[-80, -170], [80, 170]] * 500, spacing=1))
+    assert rv.status_code == 400
+    assert densified == []
+
+def test_generate_missing(client, local_tiles, monkeypatch):
+    """Test that missing tiles are generated from the HGT data, and ocean tiles where there is none"""
+    import io
+    import numpy as np
+    import fast_gen
+    import app as terrain_app
+    hgt_path = local_tiles / 'hgt3'
+    hgt_path.mkdir()
+    heights = (np.arange(1201 * 1201) % 2000).astype('>i2').reshape(1201, 1201)
+    with zipfile.ZipFile(str(hgt_path / 'S36E149.hgt.zip'), 'w') as zf:
+        zf.writestr('S36E149.hgt', heights.tobytes())
+    monkeypatch.setattr(terrain_app, 'hgt_path3', str(hgt_path))
+
+    plan = client.get('/plan?lat=-35.5&long=149.995&radius=2&version=3').get_json()
+    assert plan['generate'] == ['S36E149.DAT', 'S36E150.DAT']
+    assert plan['missing'] == []
+
+    rv = client.post('/generate', data=dict(lat='-35.5', long='149.995', radius='2', version="3"))
+    uuidkey = rv.data.split(b"footer")[1][1:-2].decode("utf-8")
+    rdown = client.get('/userRequestTerrain/' + uuidkey + ".zip")
+    assert rdown.status_code == 200
+    assert sorted(os.listdir(str(local_tiles / 'tilesdat3'))) == ['S36E149.DAT.gz', 'S36E150.DAT.gz']
+
+    # the same as the tiles fast_gen.py generates
+    expected = local_tiles / 'expected'
+    hgt_map = fast_gen.scan_hgt_dir(str(hgt_path))
+    fast_gen.process_tile(hgt_map[(-36, 149)], hgt_map, str(expected), 100, "4.1")
+    fast_gen.process_ocean_tile((-36, 150, str(expected), 100, "4.1", None, None, False))
+    with zipfile.ZipFile(io.BytesIO(rdown.data)) as zip_file:
+        for name in ['S36E149.DAT', 'S36E150.DAT']:
+            with gzip.open(str(expected / (name + '.gz'))) as f:
+                assert zip_file.read(name) == f.read()
+    assert terrain_app.metrics.counters['terraingen_tiles_generated_total'] >= 2
+
+    # a pool broken by a process being killed is replaced, spawning python rather than uwsgi
+    import concurrent.futures
+    import sys
+    monkeypatch.setattr(sys, 'executable', '/usr/bin/uwsgi')
+    assert os.path.basename(terrain_app.getGeneratorPython()).startswith('python')
+    with pytest.raises(concurrent.futures.process.BrokenProcessPool):
+        terrain_app.getGeneratorPool().submit(os._exit, 1).result()
+    rv = client.post('/generate', data=dict(lat='-35.5', long='151.5', radius='2', version="3"))
+    assert b'download="terrain.zip"' in rv.data
+    assert os.path.exists(str(local_tiles / 'tilesdat3' / 'S36E151.DAT.gz'))
+
+def test_manifest(client, local_tiles, monkeypatch):
+    """Test that a request's tiles are listed with their ETags and can be fetched individually"""
+    import zlib
+    tiles = {}
+    for lon in [149, 150]:
+        tiles['S36E%03u' % lon] = createTile(str(local_tiles / 'tilesdat3'), 'S36E%03u.DAT.gz' % lon)
+
+    rv = client.get('/manifest?lat=-35.5&long=149.995&radius=2&version=3')
+    assert rv.status_code == 200
+    manifest = rv.get_json()
+    assert [tile['name'] for tile in manifest['tiles']] == ['S36E149.DAT', 'S36E150.DAT']
+    assert manifest['missing'] == []
+    for tile in manifest['tiles']:
+        data = tiles[tile['name'][:-4]]
+        assert tile['size'] == len(data)
+        assert tile['crc32'] == zlib.crc32(data)
+
+        rv = client.get(tile['url'])
+        assert rv.status_code == 200
+        assert len(rv.data) == tile['compressed_size']
+        assert gzip.decompress(rv.data) == data
+        assert 'immutable' in rv.headers['Cache-Control']
+        assert rv.headers['ETag'] == '"%s"' % tile['etag']
+        assert client.get(tile['url'], headers={'If-None-Match': rv.headers['ETag']}).status_code == 304
+
+    # without the ETag the tile may change, so is only cached for a while
+    rv = client.get('/tiles/3/S36E149.DAT.gz')
+    assert rv.status_code == 200
+    assert 'immutable' not in rv.headers['Cache-Control']
+    assert client.get('/tiles/3/S36E151.DAT.gz').status_code == 404
+    assert client.get('/tiles/3/..%2Fapp.py').status_code == 404
+    assert client.get('/tiles/2/S36E149.DAT.gz').status_code == 404
+    assert client.get('/manifest?lat=-35.5&long=149.995&radius=2&version=2').status_code == 400
+
+    # the ETag is the same in a new process, and changes with the tile
+    import app as terrain_app
+    monkeypatch.setattr(terrain_app, 'catalogs', {})
+    etag = manifest['tiles'][0]['etag']
+    assert client.get('/manifest?lat=-35.5&long=149.995&radius=2&version=3').get_json()['tiles'][0]['etag'] == etag
+    createTile(str(local_tiles / 'tilesdat3'), 'S36E149.DAT.gz', blocks=8)
+    terrain_app.getCatalog(str(local_tiles / 'tilesdat3')).refresh(force=True)
+    assert client.get('/manifest?lat=-35.5&long=149.995&radius=2&version=3').get_json()['tiles'][0]['etag'] != etag
+
+    # tiles beyond the database aren't looked for, and those not held are rate limited
+    import app as terrain_app
+    monkeypatch.setattr(terrain_app, 'tile_fetch_limit', "2 per hour")
+    fetched = []
+    fetchTile = terrain_app.fetchTile
+    def recordFetch(fn, url_path):
+        fetched.append(fn)
+        return fetchTile(fn, url_path)
+    monkeypatch.setattr(terrain_app, 'fetchTile', recordFetch)
+    assert client.get('/tiles/3/S85E149.DAT.gz').status_code == 404
+    assert fetched == []
+    assert [client.get('/tiles/3/S37E149.DAT.gz').status_code for i in range(2)] == [404, 429]
+    assert all(client.get(manifest['tiles'][0]['url']).status_code == 200 for i in range(3))
+
+def test_download_offload(client, local_tiles, monkeypatch):
+    """Test that downloads can be handed to the web server to send"""
+    import app as terrain_app
+    createTile(str(local_tiles / 'tilesdat3'), 'S36E149.DAT.gz')
+    rv = client.post('/generate', data=dict(lat='-35.5', long='149.3', radius='1', version="3"))
+    uuidkey = rv.data.split(b"footer")[1][1:-2].decode("utf-8")
+    url = '/userRequestTerrain/' + uuidkey + '.zip'
+
+    monkeypatch.setattr(terrain_app, 'download_offload', 'X-Accel-Redirect')
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert rv.headers['X-Accel-Redirect'] == '/internal/userRequestTerrain/' + uuidkey + '.zip'
+    assert rv.mimetype == 'application/zip'
+    assert rv.data == b''
+
+    monkeypatch.setattr(terrain_app, 'download_offload', 'X-Sendfile')
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert rv.headers['X-Sendfile'] == os.path.abspath(str(local_tiles / 'userRequestTerrain' / (uuidkey + '.zip')))
+    assert rv.data == b''
+
+    # only existing bundles are handed over
+    assert client.get('/userRequestTerrain/missing.zip').status_code == 404
+    assert client.get('/userRequestTerrain/..%2Fapp.py').status_code == 404
+
+def test_warm(client, local_tiles):
+    """Test that the most popular bundles in the request logs are built ahead of requests"""
+    import warm
+    import app as terrain_app
+    for lon in [149, 150]:
+        createTile(str(local_tiles / 'tilesdat3'), 'S36E%03u.DAT.gz' % lon)
+    log = local_tiles / 'terraingen.log'
+    log.write_text('\n'.join([
+        "Generate: -35.500000000 149.300000000 1.000 version=3",
+        "[pid: 1] POST /generate => generated 300 bytes",
+        "Generate: -35.500000000 149.400000000 1.000 version=3",
+        "Generate: -35.500000000 150.500000000 1.000 version=3",
+        "Generate: -35.500000000 149.995000000 2.000 version=3",
+        "Generate: -35.500000000 149.995000000 2.000 version=3",
+        "Generate: -35.500000000 149.995000000 2.000 version=3",
+    ]) + '\n')
+
+    (ranked, tiles) = warm.rank(warm.read_requests([str(log)]))
+    assert [(count, len(filelist)) for (count, version, filelist) in ranked] == [(3, 2), (2, 1), (1, 1)]
+
+    assert warm.warm([str(log)], top=50, min_count=2, tiles=True) == 2
+    bundles = [f for f in os.listdir(str(local_tiles / 'userRequestTerrain')) if f.startswith('bundle-')]
+    assert len(bundles) == 2
+    assert len(os.listdir(str(local_tiles / 'terrainWork' / 'datcache'))) == 3
+    # already built
+    assert warm.warm([str(log)], top=50, min_count=2) == 0
+
+    hits = terrain_app.metrics.counters['terraingen_bundle_cache_hits_total']
+    rv = client.post('/generate', data=dict(lat='-35.5', long='149.995', radius='2', version="3"))
+    assert b'download="terrain.zip"' in rv.data
+    assert terrain_app.metrics.counters['terraingen_bundle_cache_hits_total'] == hits + 1
+
+def test_tile_catalog(client, local_tiles, monkeypatch):
+    """Test that the tile catalog tracks the tiles in a folder, and requests are served from it"""
+    import app as terrain_app
+    import terrain_zip
+    from tile_catalog import TileCatalog
+    tile_path = str(local_tiles / 'tilesdat3')
+    for lon in [149, 150]:
+        createTile(tile_path, 'S36E%03u.DAT.gz' % lon)
+    os.mkdir(os.path.join(tile_path, 'subdir'))
+
+    catalog = TileCatalog(tile_path, interval=3600)
+    assert len(catalog) == 2
+    assert sorted(catalog.entries) == ['S36E149.DAT.gz', 'S36E150.DAT.gz']
+    fn = os.path.join(tile_path, 'S36E149.DAT.gz')
+    entry = catalog.get('S36E149.DAT.gz')
+    with open(fn, 'rb') as f:
+        assert entry.member == terrain_zip.read_gzip_member(f)
+    assert entry.size == os.path.getsize(fn)
+
+    # new tiles are found when they are looked up, without rescanning the folder
+    createTile(tile_path, 'S36E151.DAT.gz', blocks=8)
+    scan = catalog.scan
+    def noScan():
+        raise AssertionError("folder rescanned")
+    catalog.scan = noScan
+    assert catalog.get('S36E151.DAT.gz').member.isize == 8 * 2048
+    assert catalog.get('S36E152.DAT.gz') is None
+    catalog.scan = scan
+
+    # removed tiles are dropped on the next check
+    os.remove(fn)
+    catalog.interval = 0
+    assert catalog.get('S36E149.DAT.gz') is None
+    assert len(catalog) == 2
+
+    # catalogued tiles aren't parsed again to plan or bundle them
+    rv = client.post('/plan', data=dict(lat='-35.5', long='150.5', radius='1', version="3"))
+    assert rv.json['tiles'][0]['size'] == 16 * 2048
+    def noParse(f):
+        raise AssertionError("tile parsed")
+    monkeypatch.setattr(terrain_app, 'read_gzip_member', noParse)
+    rv = client.post('/plan', data=dict(lat='-35.5', long='150.5', radius='1', version="3"))
+    assert rv.json['tiles'][0]['size'] == 16 * 2048
+    rv = client.post('/generate', data=dict(lat='-35.5', long='150.5', radius='1', version="3"))
+    assert b'download="terrain.zip"' in rv.data
+
+    # the catalogs can be built before any requests
+    del terrain_app.catalogs[tile_path]
+    terrain_app.loadCatalogs()
+    assert sorted(terrain_app.catalogs[tile_path].entries) == ['S36E150.DAT.gz', 'S36E151.DAT.gz']
+
+def test_multiarea(client, local_tiles, monkeypatch):
+    """Test that several areas, or a route, are merged into one bundle of each tile once"""
+    import app as terrain_app
+    tile_path = str(local_tiles / 'tilesdat3')
+    for lon in range(149, 152):
+        createTerrainTile(tile_path, -36, lon)
+
+    def bundle(**form):
+        rv = client.post('/generate', data=dict(version="3", **form))
+        assert b'download="terrain.zip"' in rv.data
+        uuidkey = rv.data.split(b"footer")[1][1:-2].decode("utf-8")
+        with open(os.path.join(terrain_app.output_path, uuidkey + '.zip'), 'rb') as f:
+            return zipfile.ZipFile(io.BytesIO(f.read()))
+
+    # two overlapping circles, with the shared tile once
+    zf = bundle(lat='-35.5', long='149.9', radius='20', areas='-35.5, 150.1, 20\n')
+    assert sorted(zf.namelist()) == ['S36E149.DAT', 'S36E150.DAT']
+
+    # a route across three tiles, uploaded as a mission file
+    mission = "\n".join([
+        "QGC WPL 110",
+        "0\t1\t0\t16\t0\t0\t0\t0\t-35.500000\t149.500000\t584.0\t1",
+        "1\t0\t3\t178\t0\t10\t0\t0\t0.000000\t0.000000\t0.0\t1",
+        "2\t0\t3\t16\t0\t0\t0\t0\t-35.500000\t151.500000\t100.0\t1",
+    ]) + "\n"
+    rv = client.post('/plan', data=dict(version='3', corridor='2',
+                                        mission=(io.BytesIO(mission.encode()), 'route.waypoints')))
+    assert sorted(tile['name'] for tile in rv.json['tiles']) == ['S36E149.DAT', 'S36E150.DAT', 'S36E151.DAT']
+    zf = bundle(corridor='2', mission=(io.BytesIO(mission.encode()), 'route.waypoints'))
+    assert sorted(zf.namelist()) == ['S36E149.DAT', 'S36E150.DAT', 'S36E151.DAT']
+
+    # only the blocks along the route are kept in a sparse bundle
+    sparse = bundle(corridor='2', waypoints='-35.5, 149.5\n-35.5, 151.5\n', sparse='1')
+    assert sorted(sparse.namelist()) == ['S36E149.DAT', 'S36E150.DAT', 'S36E151.DAT']
+    full = zf.read('S36E150.DAT')
+    tile = sparse.read('S36E150.DAT')
+    kept = sum(1 for i in range(0, len(tile), 2048) if tile[i:i + 2048].strip(b'\0'))
+    assert 0 < kept < len(full) // 2048 // 10
+
+    rv = client.post('/generate', data=dict(version='3', corridor='2', waypoints='north, east\n'))
+    assert b'Error' in rv.data
+
+    # areas covering too many tiles are refused before any are fetched
+    areas = ''.join('0, %d, 400\n' % lon for lon in range(-170, 180, 10))
+    rv = client.post('/plan', data=dict(lat='-35.5', long='149.5', radius='1', version='3', areas=areas))
+    assert rv.status_code == 400
+    rv = client.post('/generate', data=dict(lat='-35.5', long='149.5', radius='1', version='3', areas=areas))
+    assert b'Too many tiles' in rv.data
+    # but a single circle of the largest radius isn't, anywhere
+    for lat in range(-89, 90, 3):
+        assert len(terrain_app.getFileList(lat + 0.5, 0.5, 400, 1)[0]) <= terrain_app.max_tiles
+
+    # routes needing too many circles are refused before the circles are made
+    import terrain_query
+    densified = []
+    monkeypatch.setattr(terrain_query, 'densify', lambda *args: densified.append(args))
+    rv = client.post('/plan', data=dict(version='3', corridor='1', waypoints='-60, -170\n60, 170\n' * 500))
+    assert rv.status_code == 400
+    assert densified == []
+
+def test_coarse_spacing(client, local_tiles):
+    """Test that coarser spacing databases are generated in the same HGT pass and served as versions"""
+    import numpy as np
+    import fast_gen
+    import terrain_query
+    hgt_path = local_tiles / 'hgt3'
+    hgt_path.mkdir()
+    heights = (np.arange(1201 * 1201) % 2000).astype('>i2').reshape(1201, 1201)
+    with zipfile.ZipFile(str(hgt_path / 'S36E149.hgt.zip'), 'w') as zf:
+        zf.writestr('S36E149.hgt', heights.tobytes())
+    hgt_map = fast_gen.scan_hgt_dir(str(hgt_path))
+    fast_gen.process_tile(hgt_map[(-36, 149)], hgt_map, str(local_tiles / 'tilesdat3'), 100, "4.1",
+                          extra_outputs=[(str(local_tiles / 'tilesdat6'), 200),
+                                         (str(local_tiles / 'tilesdat9'), 300)])
+
+    sizes = {}
+    for (version, spacing) in [(3, 100), (6, 200), (9, 300)]:
+        rv = client.post('/generate', data=dict(lat='-35.5', long='149.5', radius='20', version=str(version)))
+        assert b'download="terrain.zip"' in rv.data
+        uuidkey = rv.data.split(b"footer")[1][1:-2].decode("utf-8")
+        rdown = client.get('/userRequestTerrain/' + uuidkey + ".zip")
+        data = zipfile.ZipFile(io.BytesIO(rdown.data)).read('S36E149.DAT')
+        sizes[version] = len(data)
+
+        # each grid is at its own spacing, interpolated from the same heights
+        with gzip.open(str(local_tiles / ('tilesdat%u' % version) / 'S36E149.DAT.gz')) as f:
+            assert f.read() == data
+        assert struct.unpack('<H', data[20:22])[0] == spacing
+        rv = client.post('/altitude', json=dict(version=version, points=[[-35.5, 149.5]]))
+        assert rv.json['altitudes'][0] == pytest.approx(
+            terrain_query.altitudes([-35.5], [149.5], spacing, lambda lat, lon: data)[0])
+
+    # the size falls with the square of the spacing
+    assert sizes[6] < sizes[3] / 3
+    assert sizes[9] < sizes[6] / 2
+
+    rv = client.post('/generate', data=dict(lat='-35.5', long='149.5', radius='20', version='4'))
+    assert b'Error' in rv.data
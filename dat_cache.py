@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+'''
+Cache of decompressed DAT tiles shared between app processes.
+
+Each tile is decompressed once into a file in the cache folder and then
+memory mapped by any process reading it, so all of the processes share the
+same pages. The least recently used tiles are removed once the cache grows
+beyond its size limit.
+'''
+
+import fcntl
+import gzip
+import hashlib
+import mmap
+import os
+import shutil
+import threading
+
+
+class DatCache(object):
+    def __init__(self, folder, max_bytes, metrics=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+
+    def cache_path(self, gz_path):
+        '''path of the cached copy of a tile, which changes if the tile does'''
+        st = os.stat(gz_path)
+        key = '%s:%u:%u' % (os.path.abspath(gz_path), st.st_size, st.st_mtime_ns)
+        name = os.path.basename(gz_path)[:-3]
+        return os.path.join(self.folder, hashlib.sha1(key.encode()).hexdigest()[:16] + '-' + name)
+
+    def get(self, gz_path):
+        '''get the decompressed contents of a .DAT.gz tile, as a read-only mmap'''
+        path = self.cache_path(gz_path)
+        try:
+            f = open(path, 'rb')
+            # mark as recently used
+            os.utime(path)
+            self.count('terraingen_dat_cache_hits_total')
+        except FileNotFoundError:
+            self.count('terraingen_dat_cache_misses_total')
+            self.add(gz_path, path)
+            f = open(path, 'rb')
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def count(self, name):
+        if self.metrics is not None:
+            self.metrics.inc(name)
+
+    def add(self, gz_path, path):
+        '''decompress a tile into the cache'''
+        try:
+            os.makedirs(self.folder)
+        except OSError:
+            pass
+        tmp = path + '.%u.%u.tmp' % (os.getpid(), threading.get_ident())
+        try:
+            with gzip.open(gz_path, 'rb') as f_in, open(tmp, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.replace(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        '''remove the least recently used tiles until the cache is within its size limit'''
+        with open(os.path.join(self.folder, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            for entry in os.scandir(self.folder):
+                if entry.name.startswith('.') or entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+            entries.sort()
+            for (mtime, size, path) in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
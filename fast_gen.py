@@ -7,6 +7,7 @@ Reads .hgt.zip files directly and produces .DAT.gz files.
 
 Usage:
     python3 fast_gen.py <hgt_dir> <output_dir> [options]
+    python3 fast_gen.py <hgt_dir> tilesdat3 --spacing 100 --also 200 tilesdat6 --also 300 tilesdat9
 """
 
 import argparse
@@ -17,6 +18,7 @@ import os
 import re
 import struct
 import sys
+import time
 import zipfile
 from multiprocessing import Pool
 
@@ -48,6 +50,10 @@ BITMAP = (1 << 56) - 1
 # Filename pattern: N00E006.hgt.zip or S45W067.hgt.zip
 HGT_FILENAME_RE = re.compile(r'([NS])(\d{2})([EW])(\d{3})\.hgt\.zip$')
 
+# Grid spacings (m) which can be generated: SRTM1, SRTM3, and coarser
+# databases for very large areas
+SPACINGS = [30, 100, 200, 300]
+
 
 def parse_hgt_filename(filepath):
     """Parse lat/lon from an HGT filename. Returns (lat, lon) integers."""
@@ -353,15 +359,21 @@ def dat_filename(lat_int, lon_int):
 def write_dat_gz(outpath, outname, file_buf):
     """Compress and write a DAT file atomically."""
     dat_name = outname[:-3]  # .DAT name for gzip header
-    tmp_path = outpath + '.tmp'
+    # unique to this process, so concurrent writers don't collide
+    tmp_path = outpath + '.%u.tmp' % os.getpid()
     with open(tmp_path, 'wb') as raw_f:
         with gzip.GzipFile(dat_name, 'wb', fileobj=raw_f) as f:
             f.write(file_buf)
     os.rename(tmp_path, outpath)
 
 
-def process_tile(hgt_file, hgt_map, output_dir, spacing, fmt, tile_idx=None, tile_total=None, overwrite=False):
-    """Process a single HGT tile to produce a DAT.gz file."""
+def process_tile(hgt_file, hgt_map, output_dir, spacing, fmt, tile_idx=None, tile_total=None, overwrite=False,
+                 extra_outputs=()):
+    """Process a single HGT tile to produce a DAT.gz file.
+
+    extra_outputs is a list of (output_dir, spacing) to also produce from the
+    same loaded HGT data, such as coarser spacing databases.
+    """
     coords = parse_hgt_filename(hgt_file)
     if coords is None:
         print(f"Skipping unrecognised file: {hgt_file}")
@@ -369,52 +381,59 @@ def process_tile(hgt_file, hgt_map, output_dir, spacing, fmt, tile_idx=None, til
 
     lat_int, lon_int = coords
     outname = dat_filename(lat_int, lon_int)
-    outpath = os.path.join(output_dir, outname)
     progress = f"[{tile_idx}/{tile_total}] " if tile_idx is not None else ""
 
-    if os.path.exists(outpath) and not overwrite:
-        print(f"{progress}Skipping {outname} (exists)")
+    outputs = []
+    for (out_dir, out_spacing) in [(output_dir, spacing)] + list(extra_outputs):
+        if os.path.exists(os.path.join(out_dir, outname)) and not overwrite:
+            print(f"{progress}Skipping {outname} at {out_spacing}m (exists)")
+            continue
+        outputs.append((out_dir, out_spacing))
+    if not outputs:
         return
 
     hgt_cache = {}
+    tile_dict = None
 
-    # Step 1: Enumerate valid blocks
-    valid_blocks, stride = enumerate_valid_blocks(lat_int, lon_int, spacing, fmt)
-    if not valid_blocks:
-        print(f"{progress}No valid blocks for {os.path.basename(hgt_file)}")
-        return
+    for (out_dir, out_spacing) in outputs:
+        # Step 1: Enumerate valid blocks
+        valid_blocks, stride = enumerate_valid_blocks(lat_int, lon_int, out_spacing, fmt)
+        if not valid_blocks:
+            print(f"{progress}No valid blocks for {os.path.basename(hgt_file)} at {out_spacing}m")
+            continue
 
-    # Step 2: Load elevation tiles
-    tile_dict, hgt_size = load_tile_dict(
-        lat_int, lon_int, hgt_map, hgt_cache)
+        # Step 2: Load elevation tiles, once for all of the outputs
+        if tile_dict is None:
+            tile_dict, hgt_size = load_tile_dict(
+                lat_int, lon_int, hgt_map, hgt_cache)
 
-    # Step 3: Compute grid point coordinates (vectorised, in chunks to limit memory)
-    CHUNK_SIZE = 2000
-    n_blocks = len(valid_blocks)
-    all_heights = np.zeros((n_blocks, TERRAIN_GRID_BLOCK_SIZE_X,
-                            TERRAIN_GRID_BLOCK_SIZE_Y), dtype=np.int16)
+        # Step 3: Compute grid point coordinates (vectorised, in chunks to limit memory)
+        CHUNK_SIZE = 2000
+        n_blocks = len(valid_blocks)
+        all_heights = np.zeros((n_blocks, TERRAIN_GRID_BLOCK_SIZE_X,
+                                TERRAIN_GRID_BLOCK_SIZE_Y), dtype=np.int16)
 
-    for chunk_start in range(0, n_blocks, CHUNK_SIZE):
-        chunk_end = min(chunk_start + CHUNK_SIZE, n_blocks)
-        chunk_blocks = valid_blocks[chunk_start:chunk_end]
+        for chunk_start in range(0, n_blocks, CHUNK_SIZE):
+            chunk_end = min(chunk_start + CHUNK_SIZE, n_blocks)
+            chunk_blocks = valid_blocks[chunk_start:chunk_end]
 
-        point_lat_e7, point_lon_e7 = compute_grid_points_vectorised(
-            chunk_blocks, lat_int, lon_int, spacing, fmt)
+            point_lat_e7, point_lon_e7 = compute_grid_points_vectorised(
+                chunk_blocks, lat_int, lon_int, out_spacing, fmt)
 
-        # Step 4: Interpolate heights
-        chunk_heights = interpolate_heights(
-            point_lat_e7, point_lon_e7, tile_dict, hgt_size)
+            # Step 4: Interpolate heights
+            chunk_heights = interpolate_heights(
+                point_lat_e7, point_lon_e7, tile_dict, hgt_size)
 
-        all_heights[chunk_start:chunk_end] = chunk_heights
+            all_heights[chunk_start:chunk_end] = chunk_heights
 
-    # Step 5: Pack into DAT file buffer
-    file_buf = pack_dat_file(valid_blocks, all_heights, lat_int, lon_int, spacing, fmt)
+        # Step 5: Pack into DAT file buffer
+        file_buf = pack_dat_file(valid_blocks, all_heights, lat_int, lon_int, out_spacing, fmt)
 
-    # Step 6: Compress and write atomically
-    os.makedirs(output_dir, exist_ok=True)
-    write_dat_gz(outpath, outname, file_buf)
+        # Step 6: Compress and write atomically
+        os.makedirs(out_dir, exist_ok=True)
+        write_dat_gz(os.path.join(out_dir, outname), outname, file_buf)
 
-    print(f"{progress}Generated {outname} ({n_blocks} blocks)")
+        print(f"{progress}Generated {outname} at {out_spacing}m ({n_blocks} blocks)")
 
 
 def process_ocean_tile(args):
@@ -446,6 +465,52 @@ def process_ocean_tile(args):
         traceback.print_exc()
 
 
+def scan_hgt_dir(hgt_dir):
+    """Find the .hgt.zip files in a directory, flat or in continent subdirs.
+
+    Returns dict mapping (lat, lon) to filepath.
+    """
+    all_files = glob.glob(os.path.join(hgt_dir, '**/*.hgt.zip'), recursive=True)
+    hgt_map = {}
+    for f in sorted(all_files):
+        coords = parse_hgt_filename(f)
+        if coords is not None:
+            hgt_map[coords] = f
+    return hgt_map
+
+
+# HGT directories scanned by generate_tile(): hgt_dir -> (scan time, hgt_map)
+hgt_maps = {}
+
+
+def generate_tile(outpath, hgt_dir, spacing, fmt="4.1", rescan_interval=600):
+    """Generate a single DAT.gz file on demand, for example in a worker process.
+
+    The tile is generated from the HGT data in hgt_dir, or as an ocean tile if
+    there is none for it. The scan of hgt_dir is kept for rescan_interval
+    seconds, so new HGT files are found. Returns outpath.
+    """
+    if (hgt_dir not in hgt_maps or
+            time.monotonic() - hgt_maps[hgt_dir][0] > rescan_interval):
+        hgt_maps[hgt_dir] = (time.monotonic(), scan_hgt_dir(hgt_dir))
+    hgt_map = hgt_maps[hgt_dir][1]
+
+    output_dir = os.path.dirname(outpath)
+    m = re.match(r'([NS])(\d{2})([EW])(\d{3})\.DAT\.gz$', os.path.basename(outpath))
+    if m is None:
+        raise ValueError(f"Unrecognised tile name: {outpath}")
+    lat_int = int(m.group(2)) * (-1 if m.group(1) == 'S' else 1)
+    lon_int = int(m.group(4)) * (-1 if m.group(3) == 'W' else 1)
+
+    if (lat_int, lon_int) in hgt_map:
+        process_tile(hgt_map[(lat_int, lon_int)], hgt_map, output_dir, spacing, fmt, overwrite=True)
+    else:
+        process_ocean_tile((lat_int, lon_int, output_dir, spacing, fmt, None, None, True))
+    if not os.path.exists(outpath):
+        raise IOError(f"Failed to generate {outpath}")
+    return outpath
+
+
 def process_tile_wrapper(args):
     """Wrapper for multiprocessing that unpacks arguments."""
     try:
@@ -461,8 +526,11 @@ def main():
         description='Fast HGT-to-DAT converter for ArduPilot terrain files')
     parser.add_argument('hgt_dir', help='Directory containing .hgt.zip files')
     parser.add_argument('output_dir', help='Output directory for .DAT.gz files')
-    parser.add_argument('--spacing', type=int, default=30, choices=[30, 100],
+    parser.add_argument('--spacing', type=int, default=30, choices=SPACINGS,
                         help='Grid spacing in metres (default: 30)')
+    parser.add_argument('--also', nargs=2, action='append', default=[], metavar=('SPACING', 'OUTPUT_DIR'),
+                        help='Also generate a database at another spacing from the same HGT data, '
+                             'e.g. --also 200 tilesdat6 --also 300 tilesdat9')
     parser.add_argument('--processes', type=int, default=8,
                         help='Number of parallel workers (default: 8)')
     parser.add_argument('--overwrite', action='store_true',
@@ -471,16 +539,16 @@ def main():
                         help='Generate ocean tiles for all longitudes in this latitude range '
                              '(e.g. --lat-range -85 84 for full world coverage)')
     args = parser.parse_args()
+    extra_outputs = []
+    for (spacing, output_dir) in args.also:
+        if not spacing.isdigit() or int(spacing) not in SPACINGS:
+            parser.error(f"--also spacing must be one of {SPACINGS}")
+        extra_outputs.append((output_dir, int(spacing)))
 
     # Scan for HGT files (flat or continent subdirs)
-    all_files = glob.glob(os.path.join(args.hgt_dir, '**/*.hgt.zip'), recursive=True)
-    hgt_files = []
-    for f in all_files:
-        coords = parse_hgt_filename(f)
-        if coords is not None:
-            hgt_files.append((coords, f))
+    hgt_map = scan_hgt_dir(args.hgt_dir)
     # Sort by (lat, lon) for predictable processing order
-    hgt_files.sort(key=lambda x: x[0])
+    hgt_files = sorted(hgt_map.items())
 
     if not hgt_files:
         print(f"No .hgt.zip files found in {args.hgt_dir}")
@@ -489,13 +557,13 @@ def main():
     total = len(hgt_files)
     print(f"Found {total} HGT files")
 
-    # Build lookup dict: (lat, lon) -> filepath
-    hgt_map = {coords: f for coords, f in hgt_files}
-
     os.makedirs(args.output_dir, exist_ok=True)
+    for (output_dir, spacing) in extra_outputs:
+        os.makedirs(output_dir, exist_ok=True)
 
     # Process land tiles from HGT data
-    work_args = [(f, hgt_map, args.output_dir, args.spacing, "4.1", i + 1, total, args.overwrite)
+    work_args = [(f, hgt_map, args.output_dir, args.spacing, "4.1", i + 1, total, args.overwrite,
+                  extra_outputs)
                  for i, (coords, f) in enumerate(hgt_files)]
 
     if args.processes <= 1:
@@ -510,12 +578,13 @@ def main():
         lat_min, lat_max = args.lat_range
         ocean_work = []
         idx = 0
-        for lat in range(lat_min, lat_max + 1):
-            for lon in range(-180, 180):
-                if (lat, lon) not in hgt_map:
-                    idx += 1
-                    ocean_work.append((lat, lon, args.output_dir, args.spacing,
-                                       "4.1", idx, None, args.overwrite))
+        for (output_dir, spacing) in [(args.output_dir, args.spacing)] + extra_outputs:
+            for lat in range(lat_min, lat_max + 1):
+                for lon in range(-180, 180):
+                    if (lat, lon) not in hgt_map:
+                        idx += 1
+                        ocean_work.append((lat, lon, output_dir, spacing,
+                                           "4.1", idx, None, args.overwrite))
 
         # Fill in total count
         ocean_total = len(ocean_work)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+'''
+Load test the web app against a local stand-in for the terrain server.
+
+A local HTTP server generates synthetic .DAT.gz tiles on request and is
+used as the app's url_path1/3, so nothing is fetched from
+terrain.ardupilot.org. The app runs in this process with its rate limits
+disabled, and /generate is driven by a pool of threads with a random mix
+of radii and versions. Each run reports throughput, latency percentiles,
+bytes written and the peak RSS of the process during the run, which on
+linux is measured by resetting the process's high water mark as it starts.
+
+Usage:
+    python3 load_test.py --requests 200 --concurrency 8 --radii 1,10,50 --versions 1,3
+'''
+
+import argparse
+import concurrent.futures
+import gzip
+import http.server
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from terrain_gen import IO_BLOCK_SIZE
+
+
+def synthetic_tile(name, blocks):
+    '''make the contents of a .DAT.gz tile of smooth synthetic heights'''
+    rng = np.random.RandomState(zlib.crc32(name.encode()))
+    x = np.arange(blocks * IO_BLOCK_SIZE // 2)
+    heights = 1000 + 500 * np.sin(x / 5000.0) + rng.randint(0, 20, len(x))
+    return gzip.compress(heights.astype('<i2').tobytes(), 6)
+
+
+class TileServer(object):
+    '''HTTP server generating synthetic tiles for any .DAT.gz name requested'''
+    def __init__(self, blocks=1000, delay=0):
+        self.blocks = blocks
+        self.delay = delay
+        self.tiles = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                name = os.path.basename(self.path)
+                if not name.endswith('.DAT.gz'):
+                    self.send_error(404)
+                    return
+                data = server.tile(name)
+                time.sleep(server.delay)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def tile(self, name):
+        with self.lock:
+            self.requests += 1
+            if name not in self.tiles:
+                self.tiles[name] = synthetic_tile(name, self.blocks)
+            return self.tiles[name]
+
+    def url(self, folder):
+        return 'http://127.0.0.1:%u/%s/' % (self.httpd.server_address[1], folder)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def percentile(values, p):
+    '''get the p'th percentile of a list of values'''
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def reset_peak_rss():
+    '''reset the peak RSS of this process to its current RSS, returning
+    whether it could be reset (linux 4.0 and later)'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_kb():
+    '''get the peak RSS of this process in kilobytes since it was last reset'''
+    with open('/proc/self/status') as f:
+        return int(re.search(r'^VmHWM:\s+(\d+) kB', f.read(), re.M).group(1))
+
+
+def run(requests=100, concurrency=4, radii=(1, 10, 50), versions=(1, 3), seed=1,
+        blocks=1000, delay=0, work_dir=None):
+    '''run a load test, returning a dict of the results'''
+    import app as terrain_app
+
+    temp_dir = None
+    if work_dir is None:
+        work_dir = temp_dir = tempfile.mkdtemp(prefix='terraingen-load-')
+    rng = random.Random(seed)
+    mix = [(rng.uniform(-60, 60), rng.uniform(-180, 180), rng.choice(radii), rng.choice(versions))
+           for i in range(requests)]
+
+    try:
+        with TileServer(blocks, delay) as server:
+            # point the app at the stand-in server and the work folder
+            work_path = os.path.join(work_dir, 'terrainWork')
+            settings = dict(
+                output_path=os.path.join(work_dir, 'userRequestTerrain'),
+                work_path=work_path,
+                job_path=os.path.join(work_path, 'jobs'),
+                index_path=os.path.join(work_path, 'index.sqlite'),
+                metrics_path=os.path.join(work_path, 'metrics'),
+                lock_path=os.path.join(work_path, 'locks'),
+                dat_cache_path=os.path.join(work_path, 'datcache'),
+                async_tiles=None,
+                sweep_interval=None)
+            for version in terrain_app.spacings:
+                settings['tile_path%u' % version] = os.path.join(work_dir, 'tilesdat%u' % version)
+                settings['url_path%u' % version] = server.url('tilesdat%u' % version)
+            saved = dict((name, getattr(terrain_app, name)) for name in settings)
+            saved_enabled = terrain_app.limiter.enabled
+            for (name, value) in settings.items():
+                setattr(terrain_app, name, value)
+            terrain_app.limiter.enabled = False
+            client = terrain_app.app.test_client()
+
+            def generate(params):
+                (lat, lon, radius, version) = params
+                start = time.monotonic()
+                rv = client.post('/generate', data=dict(lat=str(lat), long=str(lon),
+                                                        radius=str(radius), version=str(version)))
+                latency = time.monotonic() - start
+                if rv.status_code != 200 or b'download="terrain.zip"' not in rv.data:
+                    return (latency, None)
+                uuidkey = rv.data.split(b"footer")[1][1:-2].decode("utf-8")
+                return (latency, os.path.getsize(os.path.join(settings['output_path'], uuidkey + '.zip')))
+
+            try:
+                # the peak of this run, not of the imports or earlier runs
+                measure_rss = reset_peak_rss()
+                start = time.monotonic()
+                with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    results = list(pool.map(generate, mix))
+                elapsed = time.monotonic() - start
+                peak_rss = peak_rss_kb() if measure_rss else None
+            finally:
+                for (name, value) in saved.items():
+                    setattr(terrain_app, name, value)
+                terrain_app.limiter.enabled = saved_enabled
+            tile_requests = server.requests
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    latencies = [latency for (latency, size) in results]
+    sizes = [size for (latency, size) in results if size is not None]
+    return dict(requests=requests, concurrency=concurrency,
+                failures=requests - len(sizes),
+                seconds=elapsed,
+                throughput=requests / elapsed,
+                latency_p50=percentile(latencies, 50),
+                latency_p99=percentile(latencies, 99),
+                bytes_written=sum(sizes),
+                tile_requests=tile_requests,
+                # None where it can't be measured
+                peak_rss_kb=peak_rss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the terrain generator web app')
+    parser.add_argument('--requests', type=int, default=100, help='Number of /generate requests (default: 100)')
+    parser.add_argument('--concurrency', type=int, default=4, help='Requests in flight at once (default: 4)')
+    parser.add_argument('--radii', default='1,10,50', help='Comma separated radii (km) to pick from (default: 1,10,50)')
+    parser.add_argument('--versions', default='1,3', help='Comma separated versions to pick from (default: 1,3)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the request mix (default: 1)')
+    parser.add_argument('--tile-blocks', type=int, default=1000,
+                        help='Number of 2048 byte blocks in each synthetic tile (default: 1000)')
+    parser.add_argument('--server-delay', type=float, default=0,
+                        help='Seconds the tile server waits before each response (default: 0)')
+    parser.add_argument('--work-dir', default=None,
+                        help='Folder for tiles and bundles, kept between runs (default: a temporary folder)')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    results = run(requests=args.requests, concurrency=args.concurrency,
+                  radii=[int(r) for r in args.radii.split(',')],
+                  versions=[int(v) for v in args.versions.split(',')],
+                  seed=args.seed, blocks=args.tile_blocks, delay=args.server_delay,
+                  work_dir=args.work_dir)
+    if args.json:
+        print(json.dumps(results))
+        return
+    print("Requests:      %u (%u failed), concurrency %u" % (results['requests'], results['failures'],
+                                                           results['concurrency']))
+    print("Throughput:    %.2f requests/s over %.1fs" % (results['throughput'], results['seconds']))
+    print("Latency:       p50 %.3fs, p99 %.3fs" % (results['latency_p50'], results['latency_p99']))
+    print("Bytes written: %.1f MB" % (results['bytes_written'] / (1024.0 * 1024.0)))
+    print("Tile requests: %u" % results['tile_requests'])
+    if results['peak_rss_kb'] is not None:
+        print("Peak RSS:      %.1f MB" % (results['peak_rss_kb'] / 1024.0))
+    else:
+        print("Peak RSS:      unavailable")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+'''
+Prometheus style counters and histograms shared between app processes.
+
+Each process keeps its own values in memory and saves them to a file of
+its own in a shared folder. Any process can then report the totals over
+all of the files, in the Prometheus text exposition format. The files of
+processes which have exited are merged into a single file by retire(), so
+the totals are kept without the folder growing with every restart.
+'''
+
+import bisect
+import contextlib
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+
+# default histogram buckets, in seconds
+TIME_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+# histogram buckets for sizes, in bytes
+SIZE_BUCKETS = [2**n for n in range(16, 34, 2)]
+
+# the totals of the processes which have exited
+RETIRED = 'retired.json'
+
+
+@contextlib.contextmanager
+def folder_lock(folder, operation):
+    '''hold a lock on the folder, shared to read the files or exclusive to merge them'''
+    try:
+        os.makedirs(folder)
+    except OSError:
+        pass
+    with open(os.path.join(folder, '.lock'), 'a') as lock:
+        fcntl.flock(lock, operation)
+        yield
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def add_values(total, data):
+    '''add the values saved in data to the dict of totals'''
+    for (name, value) in data['counters'].items():
+        total['counters'][name] = total['counters'].get(name, 0) + value
+    for (name, values) in data['histograms'].items():
+        if name not in total['histograms']:
+            total['histograms'][name] = list(values)
+        elif len(values) == len(total['histograms'][name]):
+            total['histograms'][name] = [a + b for (a, b) in zip(total['histograms'][name], values)]
+
+
+def retire(folder):
+    '''merge the files of processes which have exited into the retired totals,
+    returning the number merged'''
+    if not os.path.isdir(folder):
+        return 0
+    with folder_lock(folder, fcntl.LOCK_EX):
+        dead = []
+        for filename in os.listdir(folder):
+            m = re.match(r'^(\d+)-\d+\.json$', filename)
+            if m is not None and not process_exists(int(m.group(1))):
+                dead.append(filename)
+        if not dead:
+            return 0
+        total = dict(counters={}, histograms={})
+        for filename in [RETIRED] + dead:
+            try:
+                with open(os.path.join(folder, filename)) as f:
+                    add_values(total, json.load(f))
+            except (OSError, ValueError):
+                continue
+        path = os.path.join(folder, RETIRED)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(total, f)
+        os.replace(path + '.tmp', path)
+        for filename in dead:
+            os.remove(os.path.join(folder, filename))
+        return len(dead)
+
+
+class Timer(object):
+    '''context manager observing the time taken into a histogram'''
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.monotonic() - self.start)
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.buckets = {}
+        self.counters = {}
+        self.histograms = {}
+        self.dirty = False
+        self.saved = None
+        # unique to this process, even if its pid is reused later
+        self.filename = '%u-%u.json' % (os.getpid(), time.time() * 1000)
+        self.pid = os.getpid()
+
+    def counter(self, name, help):
+        '''declare a counter'''
+        self.help[name] = help
+        self.counters[name] = 0
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        '''declare a histogram'''
+        self.help[name] = help
+        self.buckets[name] = buckets
+        # count in each bucket and over the last, then sum and count
+        self.histograms[name] = [0] * (len(buckets) + 1) + [0, 0]
+
+    def check_fork(self):
+        '''start afresh in a forked process, which must not report the parent's values'''
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.filename = '%u-%u.json' % (os.getpid(), time.time() * 1000)
+            for name in self.counters:
+                self.counters[name] = 0
+            for name in self.histograms:
+                self.histograms[name] = [0] * len(self.histograms[name])
+
+    def inc(self, name, value=1):
+        '''increase a counter'''
+        with self.lock:
+            self.check_fork()
+            self.counters[name] += value
+            self.dirty = True
+
+    def observe(self, name, value):
+        '''add a value to a histogram'''
+        with self.lock:
+            self.check_fork()
+            values = self.histograms[name]
+            values[bisect.bisect_left(self.buckets[name], value)] += 1
+            values[-2] += value
+            values[-1] += 1
+            self.dirty = True
+
+    def time(self, name):
+        '''time a block of code into a histogram'''
+        return Timer(self, name)
+
+    def save(self, folder):
+        '''save this process's values, if they have changed'''
+        with self.lock:
+            self.check_fork()
+            if not self.dirty and self.saved == folder:
+                return
+            data = json.dumps(dict(counters=self.counters, histograms=self.histograms))
+            self.dirty = False
+            self.saved = folder
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass
+        path = os.path.join(folder, self.filename)
+        tmp = path + '.%u.tmp' % threading.get_ident()
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def collect(self, folder):
+        '''get the totals of the values saved by every process'''
+        counters = dict((name, 0) for name in self.counters)
+        histograms = dict((name, [0] * len(values)) for (name, values) in self.histograms.items())
+        if not os.path.isdir(folder):
+            return (counters, histograms)
+        with folder_lock(folder, fcntl.LOCK_SH):
+            saved = []
+            for filename in os.listdir(folder):
+                if not filename.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(folder, filename)) as f:
+                        saved.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        for data in saved:
+            for (name, value) in data['counters'].items():
+                if name in counters:
+                    counters[name] += value
+            for (name, values) in data['histograms'].items():
+                if name in histograms and len(values) == len(histograms[name]):
+                    histograms[name] = [a + b for (a, b) in zip(histograms[name], values)]
+        return (counters, histograms)
+
+    def render(self, folder):
+        '''get the totals in the Prometheus text format'''
+        self.save(folder)
+        (counters, histograms) = self.collect(folder)
+        lines = []
+        for name in sorted(counters):
+            lines.append('# HELP %s %s' % (name, self.help[name]))
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %s' % (name, counters[name]))
+        for name in sorted(histograms):
+            values = histograms[name]
+            lines.append('# HELP %s %s' % (name, self.help[name]))
+            lines.append('# TYPE %s histogram' % name)
+            total = 0
+            for (le, count) in zip(self.buckets[name], values):
+                total += count
+                lines.append('%s_bucket{le="%s"} %u' % (name, le, total))
+            lines.append('%s_bucket{le="+Inf"} %u' % (name, values[-1]))
+            lines.append('%s_sum %s' % (name, values[-2]))
+            lines.append('%s_count %u' % (name, values[-1]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+'''
+Expire generated terrain files in the background.
+
+The app records each file it generates in an index shared between its
+processes, and the sweeper removes expired files from the index in batches,
+so no request has to scan the output folder.
+
+Bundles are kept in a store with a size quota instead. Once the store is over
+its quota the least recently downloaded bundles are removed, but only after
+they have existed for a minimum time.
+
+Usage:
+    python3 sweeper.py <index> <folder> [<folder> ...] [--store <folder> --quota <bytes>] [--once]
+'''
+
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import retire as retire_metrics
+
+
+class FileIndex(object):
+    '''index of generated files and when they were created'''
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def db(self):
+        '''get this thread's connection to the index'''
+        if getattr(self.local, 'db', None) is None:
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                pass
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.create(db)
+            self.local.db = db
+        return self.local.db
+
+    def create(self, db):
+        '''create the tables, if they don't exist'''
+        db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, created REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS files_created ON files (created)')
+
+    def add(self, path, created=None):
+        '''record a generated file, or restart its lifetime'''
+        if created is None:
+            created = time.time()
+        self.db().execute('INSERT OR REPLACE INTO files VALUES (?, ?)', (os.path.abspath(path), created))
+
+    def adopt(self, folder):
+        '''index any files in a folder which aren't already, such as files left by
+        a crash, using their modification time as their creation time'''
+        rows = []
+        for entry in os.scandir(folder):
+            if entry.is_file():
+                rows.append((os.path.abspath(entry.path), entry.stat().st_mtime))
+        self.db().executemany('INSERT OR IGNORE INTO files VALUES (?, ?)', rows)
+        return len(rows)
+
+    def sweep(self, max_age, batch_size=100):
+        '''remove files created more than max_age seconds ago, returning how many were removed'''
+        db = self.db()
+        removed = 0
+        while True:
+            before = time.time() - max_age
+            # lock the index while a batch is removed, so concurrent
+            # sweepers don't remove the same files
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                paths = [row[0] for row in db.execute(
+                    'SELECT path FROM files WHERE created < ? ORDER BY created LIMIT ?',
+                    (before, batch_size))]
+                for path in paths:
+                    try:
+                        os.remove(path)
+                        print("Removing old file: " + path)
+                    except FileNotFoundError:
+                        pass
+                db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in paths])
+                db.execute('COMMIT')
+            except:
+                db.execute('ROLLBACK')
+                raise
+            removed += len(paths)
+            if len(paths) < batch_size:
+                return removed
+
+
+class FileStore(FileIndex):
+    '''index of generated files limited to quota bytes in total, removing the
+    least recently used files that are at least min_age seconds old first.
+    Hard links to the same file are counted, and removed, together'''
+    def __init__(self, path, quota, min_age):
+        FileIndex.__init__(self, path)
+        self.quota = quota
+        self.min_age = min_age
+
+    def create(self, db):
+        db.execute('CREATE TABLE IF NOT EXISTS store '
+                   '(path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, created REAL, used REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS store_inode ON store (inode)')
+
+    def add(self, path, created=None):
+        '''record a generated file, or restart its lifetime'''
+        if created is None:
+            created = time.time()
+        st = os.stat(path)
+        self.db().execute('INSERT OR REPLACE INTO store VALUES (?, ?, ?, ?, ?)',
+                          (os.path.abspath(path), st.st_ino, st.st_size, created, created))
+
+    def touch(self, path):
+        '''record a file being used, such as being downloaded'''
+        self.db().execute('UPDATE store SET used = ? WHERE path = ?', (time.time(), os.path.abspath(path)))
+
+    def adopt(self, folder):
+        '''index any files in a folder which aren't already, using their
+        modification time as their creation and last use'''
+        rows = []
+        for entry in os.scandir(folder):
+            if entry.is_file():
+                st = entry.stat()
+                rows.append((os.path.abspath(entry.path), st.st_ino, st.st_size, st.st_mtime, st.st_mtime))
+        self.db().executemany('INSERT OR IGNORE INTO store VALUES (?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def size(self):
+        '''get the total size of the files, counting hard links once'''
+        (size,) = self.db().execute(
+            'SELECT TOTAL(size) FROM (SELECT MAX(size) AS size FROM store GROUP BY inode)').fetchone()
+        return int(size)
+
+    def sweep(self, max_age=None, batch_size=100):
+        '''remove the least recently used files until the store is within its
+        quota, returning how many were removed. max_age is ignored'''
+        db = self.db()
+        removed = 0
+        while True:
+            # lock the index while a batch is removed, so concurrent
+            # sweepers don't remove the same files
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                excess = self.size() - self.quota
+                inodes = []
+                if excess > 0:
+                    for (inode, size) in db.execute(
+                            'SELECT inode, MAX(size) FROM store GROUP BY inode HAVING MAX(created) < ? '
+                            'ORDER BY MAX(used) LIMIT ?', (time.time() - self.min_age, batch_size)):
+                        if excess <= 0:
+                            break
+                        inodes.append(inode)
+                        excess -= size
+                paths = [row[0] for inode in inodes for row in
+                         db.execute('SELECT path FROM store WHERE inode = ?', (inode,))]
+                for path in paths:
+                    try:
+                        os.remove(path)
+                        print("Removing least recently used file: " + path)
+                    except FileNotFoundError:
+                        pass
+                db.executemany('DELETE FROM store WHERE path = ?', [(path,) for path in paths])
+                db.execute('COMMIT')
+            except:
+                db.execute('ROLLBACK')
+                raise
+            removed += len(paths)
+            if excess <= 0 or len(inodes) < batch_size:
+                return removed
+
+
+def run(index, folders, max_age, interval, metrics=None, store=None, store_folders=(), metrics_folder=None):
+    '''sweep the folders, and the store's folders, forever, merging the
+    metrics files of exited processes in metrics_folder'''
+    for folder in folders:
+        if os.path.isdir(folder):
+            index.adopt(folder)
+    for folder in store_folders:
+        if os.path.isdir(folder):
+            store.adopt(folder)
+    while True:
+        start = time.monotonic()
+        try:
+            removed = index.sweep(max_age)
+            if store is not None:
+                removed += store.sweep()
+            if metrics_folder is not None:
+                retire_metrics(metrics_folder)
+            if metrics is not None:
+                metrics.observe('terraingen_sweep_seconds', time.monotonic() - start)
+                metrics.inc('terraingen_files_expired_total', removed)
+        except Exception as ex:
+            print("Sweep failed: {0}".format(ex))
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Expire generated terrain files')
+    parser.add_argument('index', help='Index of generated files')
+    parser.add_argument('folders', nargs='*', help='Folders of generated files')
+    parser.add_argument('--max-age', type=float, default=24 * 60 * 60,
+                        help='Lifetime of generated files in seconds (default: 24 hours)')
+    parser.add_argument('--interval', type=float, default=600,
+                        help='Seconds between sweeps (default: 600)')
+    parser.add_argument('--store', action='append', default=[],
+                        help='Folder of generated files limited by --quota instead of --max-age')
+    parser.add_argument('--quota', type=int, default=50 * 1024**3,
+                        help='Most bytes of files kept in the --store folders (default: 50 GB)')
+    parser.add_argument('--min-age', type=float, default=60 * 60,
+                        help='Seconds files in the --store folders are kept regardless of the quota (default: 3600)')
+    parser.add_argument('--metrics', default=None,
+                        help='Folder of app metrics, whose files from exited processes are merged')
+    parser.add_argument('--once', action='store_true',
+                        help='Sweep once and exit')
+    args = parser.parse_args()
+
+    index = FileIndex(args.index)
+    store = FileStore(args.index, args.quota, args.min_age)
+    if args.once:
+        for folder in args.folders:
+            if os.path.isdir(folder):
+                index.adopt(folder)
+        for folder in args.store:
+            if os.path.isdir(folder):
+                store.adopt(folder)
+        print("Removed %u files" % (index.sweep(args.max_age) + store.sweep()))
+        if args.metrics is not None:
+            print("Merged %u metrics files" % retire_metrics(args.metrics))
+    else:
+        run(index, args.folders, args.max_age, args.interval, store=store, store_folders=args.store,
+            metrics_folder=args.metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+'''
+Look up terrain altitudes in DAT tiles, vectorised with numpy.
+
+Altitudes are interpolated from the grid exactly as AP_Terrain does on the
+vehicle: each point is located relative to the south west corner of its
+degree tile, the grid block holding it is read from the tile, and the four
+surrounding grid points are interpolated bilinearly.
+'''
+
+import numpy as np
+
+from terrain_gen import (
+    east_blocks, LOCATION_SCALING_FACTOR, IO_BLOCK_SIZE,
+    TERRAIN_GRID_BLOCK_SPACING_X, TERRAIN_GRID_BLOCK_SPACING_Y, TERRAIN_GRID_BLOCK_SIZE_Y,
+)
+
+# the fields of a DAT block used to check it is the one expected
+BLOCK_DTYPE = np.dtype({'names': ['version', 'spacing', 'grid_idx_x', 'grid_idx_y'],
+                        'formats': ['<u2', '<u2', '<u2', '<u2'],
+                        'offsets': [18, 20, 1814, 1816], 'itemsize': IO_BLOCK_SIZE})
+
+# offset of the heights in a block, in int16s
+HEIGHTS_OFFSET = 11
+
+
+def longitude_scale(lat):
+    '''get longitude scale factors, emulating single precision like terrain_gen'''
+    scale = np.cos(np.radians(lat).astype(np.float32).astype(np.float64)).astype(np.float32)
+    return np.maximum(scale.astype(np.float64), 0.01)
+
+
+def diff_longitude_e7(lon1, lon2):
+    '''get longitude differences, handling wrap'''
+    dlon = lon1 - lon2
+    wrap = (lon1 * lon2) < 0
+    dlon = np.where(wrap & (dlon > 1800000000), dlon - 3600000000, dlon)
+    return np.where(wrap & (dlon < -1800000000), dlon + 3600000000, dlon)
+
+
+def distance_ne_e7(lat1, lon1, lat2, lon2, fmt="4.1"):
+    '''get the north and east distances between positions in 1e7 format'''
+    if fmt == "pre-4.1":
+        return ((lat2 - lat1) * LOCATION_SCALING_FACTOR,
+                (lon2 - lon1) * LOCATION_SCALING_FACTOR * longitude_scale(lat1 * 1.0e-7))
+    dlng = diff_longitude_e7(lon2, lon1) * longitude_scale((lat1 + lat2) * 0.5 * 1.0e-7)
+    return ((lat2 - lat1) * LOCATION_SCALING_FACTOR, dlng * LOCATION_SCALING_FACTOR)
+
+
+def to_e7(degrees):
+    '''convert degrees to 1e7 format, truncating like int()'''
+    return np.trunc(np.asarray(degrees, dtype=np.float64) * 1.0e7).astype(np.int64)
+
+
+def tile_degrees(lat_e7, lon_e7):
+    '''get the degree tile holding each position, as AP_Terrain names them'''
+    return (lat_e7 // 10000000, lon_e7 // 10000000)
+
+
+def tile_altitudes(data, lat_int, lon_int, lat_e7, lon_e7, spacing, fmt="4.1"):
+    '''get the altitudes of positions within the tile lat_int, lon_int whose
+    decompressed contents are data, NaN where the tile has no data'''
+    ref_lat = lat_int * 10000000
+    ref_lon = lon_int * 10000000
+    (north, east) = distance_ne_e7(ref_lat, ref_lon, lat_e7, lon_e7, fmt)
+
+    idx_x = np.trunc(north / spacing).astype(np.int64)
+    idx_y = np.trunc(east / spacing).astype(np.int64)
+    grid_idx_x = idx_x // TERRAIN_GRID_BLOCK_SPACING_X
+    grid_idx_y = idx_y // TERRAIN_GRID_BLOCK_SPACING_Y
+    local_x = idx_x % TERRAIN_GRID_BLOCK_SPACING_X
+    local_y = idx_y % TERRAIN_GRID_BLOCK_SPACING_Y
+    frac_x = (north - idx_x * spacing) / spacing
+    frac_y = (east - idx_y * spacing) / spacing
+
+    count = len(data) // IO_BLOCK_SIZE
+    stride = east_blocks(ref_lat, ref_lon, spacing, fmt)
+    blocknum = stride * grid_idx_x + grid_idx_y
+    valid = (grid_idx_x >= 0) & (grid_idx_y >= 0) & (grid_idx_y < stride) & (blocknum < count)
+    blocknum = np.where(valid, blocknum, 0)
+
+    result = np.full(len(lat_e7), np.nan)
+    if count == 0 or not valid.any():
+        return result
+
+    # only use blocks which are present, at the expected grid position
+    blocks = np.frombuffer(data, dtype=BLOCK_DTYPE, count=count)[blocknum]
+    valid &= ((blocks['version'] != 0) & (blocks['spacing'] == spacing) &
+              (blocks['grid_idx_x'] == grid_idx_x) & (blocks['grid_idx_y'] == grid_idx_y))
+
+    heights = np.frombuffer(data, dtype='<i2', count=count * IO_BLOCK_SIZE // 2).reshape(count, -1)
+    index = HEIGHTS_OFFSET + local_x * TERRAIN_GRID_BLOCK_SIZE_Y + local_y
+    h00 = heights[blocknum, index]
+    h01 = heights[blocknum, index + 1]
+    h10 = heights[blocknum, index + TERRAIN_GRID_BLOCK_SIZE_Y]
+    h11 = heights[blocknum, index + TERRAIN_GRID_BLOCK_SIZE_Y + 1]
+
+    avg1 = (1 - frac_x) * h00 + frac_x * h10
+    avg2 = (1 - frac_x) * h01 + frac_x * h11
+    result[valid] = ((1 - frac_y) * avg1 + frac_y * avg2)[valid]
+    return result
+
+
+def altitudes(lat, lon, spacing, read_tile, fmt="4.1"):
+    '''get the altitudes of positions given in degrees, NaN where there is no
+    data. read_tile(lat_int, lon_int) gets the decompressed contents of a
+    tile, or None if it is not available'''
+    lat_e7 = to_e7(lat)
+    lon_e7 = to_e7(lon)
+    result = np.full(len(lat_e7), np.nan)
+    (lat_int, lon_int) = tile_degrees(lat_e7, lon_e7)
+    (tiles, inverse, counts) = np.unique(np.stack([lat_int, lon_int], axis=1), axis=0,
+                                         return_inverse=True, return_counts=True)
+    # the points in each tile
+    groups = np.split(np.argsort(inverse.reshape(-1), kind='stable'), np.cumsum(counts)[:-1])
+    for ((tile_lat, tile_lon), points) in zip(tiles, groups):
+        data = read_tile(int(tile_lat), int(tile_lon))
+        if data is None:
+            continue
+        result[points] = tile_altitudes(data, int(tile_lat), int(tile_lon),
+                                        lat_e7[points], lon_e7[points], spacing, fmt)
+    return result
+
+
+def leg_lengths(lat, lon, fmt="4.1"):
+    '''get the length in metres of each leg of a polyline given in degrees'''
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    (north, east) = distance_ne_e7(to_e7(lat[:-1]), to_e7(lon[:-1]), to_e7(lat[1:]), to_e7(lon[1:]), fmt)
+    return np.hypot(north, east)
+
+
+def densify(lat, lon, spacing, fmt="4.1"):
+    '''get points every spacing metres along a polyline given in degrees,
+    including its end, returning (distance, lat, lon) arrays'''
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    lengths = leg_lengths(lat, lon, fmt)
+    ends = np.concatenate([[0.0], np.cumsum(lengths)])
+
+    distance = np.append(np.arange(0, ends[-1], spacing), ends[-1])
+    if len(lengths) == 0:
+        return (distance, lat.copy(), lon.copy())
+    segment = np.clip(np.searchsorted(ends, distance, side='right') - 1, 0, len(lengths) - 1)
+    frac = np.where(lengths[segment] > 0, (distance - ends[segment]) / np.maximum(lengths[segment], 1e-9), 0)
+    dlon = (lon[1:] - lon[:-1] + 180) % 360 - 180
+    sample_lon = lon[segment] + frac * dlon[segment]
+    sample_lon = np.where(sample_lon > 180, sample_lon - 360, np.where(sample_lon < -180, sample_lon + 360, sample_lon))
+    sample_lat = lat[segment] + frac * (lat[1:] - lat[:-1])[segment]
+    return (distance, sample_lat, sample_lon)
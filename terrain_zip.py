@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+'''
+Build terrain.zip bundles directly from .DAT.gz tiles.
+
+A single member gzip file holds a raw DEFLATE stream followed by the CRC32
+and uncompressed size of the data, which is everything a zip entry needs.
+The zip writer here splices that stream into the zip unchanged, so building
+a bundle is pure file copying with no decompression or recompression.
+'''
+
+import collections
+import errno
+import os
+import struct
+import time
+import zipfile
+import zlib
+
+# gzip header flags
+FTEXT = 0x01
+FHCRC = 0x02
+FEXTRA = 0x04
+FNAME = 0x08
+FCOMMENT = 0x10
+
+ZIP_VERSION = 20
+ZIP_CREATE_SYSTEM = 3  # unix, so the external attributes are file modes
+ZIP_MAX_OFFSET = 0xFFFFFFFF
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# a parsed gzip member: where its DEFLATE stream starts, how long it is,
+# and the CRC32 and size of the uncompressed data
+GzipMember = collections.namedtuple('GzipMember', ['offset', 'size', 'crc', 'isize'])
+
+
+def read_gzip_member(f):
+    '''parse the header and trailer of a single member gzip file'''
+    header = f.read(10)
+    if len(header) != 10 or header[:3] != b'\x1f\x8b\x08':
+        raise ValueError("Not a gzip file")
+    flags = header[3]
+    if flags & 0xE0:
+        raise ValueError("Reserved gzip flags set")
+    if flags & FEXTRA:
+        (xlen,) = struct.unpack('<H', f.read(2))
+        f.read(xlen)
+    for flag in (FNAME, FCOMMENT):
+        if flags & flag:
+            while True:
+                c = f.read(1)
+                if c in (b'\x00', b''):
+                    break
+    if flags & FHCRC:
+        f.read(2)
+    offset = f.tell()
+    end = f.seek(0, os.SEEK_END)
+    if end - offset < 8:
+        raise ValueError("Truncated gzip file")
+    f.seek(end - 8)
+    (crc, isize) = struct.unpack('<II', f.read(8))
+    return GzipMember(offset, end - offset - 8, crc, isize)
+
+
+def deflate_data(data, level=9):
+    '''compress data into a raw DEFLATE stream, returning a GzipMember
+    describing the stream and the stream itself'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    stream = compressor.compress(data) + compressor.flush()
+    return (GzipMember(0, len(stream), zlib.crc32(data), len(data)), stream)
+
+
+def read_central_directory(f):
+    '''read the central directory and end record of a zip without a comment,
+    such as one written by ZipWriter'''
+    end = f.seek(0, os.SEEK_END)
+    if end < 22:
+        raise ValueError("Not a zip file")
+    f.seek(end - 22)
+    record = f.read(22)
+    (signature, disk, cd_disk, disk_entries, entries,
+     cd_size, cd_offset, comment_length) = struct.unpack('<IHHHHIIH', record)
+    if signature != 0x06054b50 or cd_offset + cd_size != end - 22:
+        raise ValueError("Not a zip file")
+    f.seek(cd_offset)
+    return f.read(cd_size) + record
+
+
+def central_directory_entries(directory):
+    '''get the (name, crc, compressed size, size) of each entry in a central
+    directory read by read_central_directory()'''
+    entries = []
+    offset = 0
+    while offset + 46 <= len(directory):
+        (signature, crc, compressed_size, size, name_length, extra_length,
+         comment_length) = struct.unpack('<I12xIIIHHH', directory[offset:offset + 34])
+        if signature != 0x02014b50:
+            break
+        name = directory[offset + 46:offset + 46 + name_length].decode('utf-8')
+        entries.append((name, crc, compressed_size, size))
+        offset += 46 + name_length + extra_length + comment_length
+    return entries
+
+
+def dos_datetime(t):
+    '''get the zip (MS-DOS) date and time fields for a timestamp'''
+    tm = time.localtime(t)
+    dostime = (tm.tm_hour << 11) | (tm.tm_min << 5) | (tm.tm_sec // 2)
+    dosdate = ((max(tm.tm_year, 1980) - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday
+    return dostime, dosdate
+
+
+def zip_size(entries, streaming=False):
+    '''get the size of the zip ZipWriter builds from (name, member) entries'''
+    size = 22
+    for (name, member) in entries:
+        size += 30 + 46 + 2 * len(name) + member.size
+        if streaming:
+            size += 16
+    return size
+
+
+class ZipWriter(object):
+    '''
+    minimal zip writer for DEFLATE entries whose compressed data is already
+    available, such as the stream inside a .DAT.gz tile
+
+    In streaming mode each entry is followed by a data descriptor and the
+    writer never needs to seek, so the zip can be sent to a client entry by
+    entry using the iter_* methods without being stored anywhere first.
+    '''
+    def __init__(self, fp, streaming=False):
+        self.fp = fp
+        self.streaming = streaming
+        self.flags = ZIP_FLAG_DATA_DESCRIPTOR if streaming else 0
+        self.offset = 0
+        self.entries = []
+        (self.dostime, self.dosdate) = dos_datetime(time.time())
+
+    def add_gzip(self, name, path):
+        '''add a .DAT.gz file as the entry name, without recompressing it'''
+        with open(path, 'rb') as f:
+            self.add_member(name, f, read_gzip_member(f))
+
+    def add_member(self, name, f, member):
+        '''add the gzip member already parsed from open file f'''
+        self.fp.write(self.local_header(name, member))
+        self.copy(f, member.offset, member.size)
+        self.fp.write(self.data_descriptor(member))
+
+    def add_data(self, name, data):
+        '''add data which isn't already compressed as the entry name'''
+        (member, stream) = deflate_data(data)
+        self.fp.write(self.local_header(name, member))
+        self.fp.write(stream)
+        self.fp.write(self.data_descriptor(member))
+
+    def iter_gzip(self, name, path):
+        '''generate the bytes of the entry add_gzip() would write'''
+        with open(path, 'rb') as f:
+            for chunk in self.iter_member(name, f, read_gzip_member(f)):
+                yield chunk
+
+    def iter_member(self, name, f, member):
+        '''generate the bytes of the entry add_member() would write'''
+        yield self.local_header(name, member)
+        f.seek(member.offset)
+        count = member.size
+        while count > 0:
+            chunk = f.read(min(count, COPY_CHUNK_SIZE))
+            if not chunk:
+                raise ValueError("Unexpected end of file")
+            count -= len(chunk)
+            yield chunk
+        yield self.data_descriptor(member)
+
+    def iter_data(self, name, data):
+        '''generate the bytes of the entry add_data() would write'''
+        (member, stream) = deflate_data(data)
+        yield self.local_header(name, member)
+        yield stream
+        yield self.data_descriptor(member)
+
+    def local_header(self, name, member):
+        '''get the local header for an entry and record it for the central directory'''
+        if self.offset + member.size > ZIP_MAX_OFFSET or member.isize > ZIP_MAX_OFFSET:
+            raise zipfile.LargeZipFile("Zip file would require ZIP64 extensions")
+        name = name.encode('ascii')
+        self.entries.append((name, member, self.offset))
+        if self.streaming:
+            # sizes and CRC follow the data
+            (crc, size, isize) = (0, 0, 0)
+        else:
+            (crc, size, isize) = (member.crc, member.size, member.isize)
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, ZIP_VERSION, self.flags,
+                             zipfile.ZIP_DEFLATED, self.dostime, self.dosdate,
+                             crc, size, isize, len(name), 0) + name
+        self.offset += len(header) + member.size
+        return header
+
+    def data_descriptor(self, member):
+        '''get the data descriptor that follows an entry in streaming mode'''
+        if not self.streaming:
+            return b''
+        descriptor = struct.pack('<IIII', 0x08074b50, member.crc, member.size, member.isize)
+        self.offset += len(descriptor)
+        return descriptor
+
+    def copy(self, f, offset, count):
+        '''copy count bytes from offset in file f to the zip'''
+        try:
+            out_fd = self.fp.fileno()
+        except (AttributeError, OSError):
+            out_fd = None
+        if out_fd is not None and hasattr(os, 'sendfile'):
+            self.fp.flush()
+            try:
+                while count > 0:
+                    sent = os.sendfile(out_fd, f.fileno(), offset, count)
+                    if sent == 0:
+                        raise ValueError("Unexpected end of file")
+                    offset += sent
+                    count -= sent
+                return
+            except OSError as ex:
+                # sendfile() to a regular file isn't supported everywhere
+                if ex.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                    raise
+        f.seek(offset)
+        while count > 0:
+            chunk = f.read(min(count, COPY_CHUNK_SIZE))
+            if not chunk:
+                raise ValueError("Unexpected end of file")
+            self.fp.write(chunk)
+            count -= len(chunk)
+
+    def central_directory(self):
+        '''get the central directory that ends the zip'''
+        records = []
+        for (name, member, offset) in self.entries:
+            records.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50,
+                                       (ZIP_CREATE_SYSTEM << 8) | ZIP_VERSION, ZIP_VERSION,
+                                       self.flags, zipfile.ZIP_DEFLATED, self.dostime, self.dosdate,
+                                       member.crc, member.size, member.isize, len(name), 0, 0, 0, 0,
+                                       0o644 << 16, offset) + name)
+        records = b''.join(records)
+        end = struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries),
+                          len(records), self.offset, 0)
+        self.offset += len(records) + len(end)
+        return records + end
+
+    def close(self):
+        '''write the central directory'''
+        self.fp.write(self.central_directory())
+        self.fp.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+'''
+In-memory catalog of the .DAT.gz tiles in a tile folder.
+
+The catalog holds each tile's compressed size, modification time and gzip
+member (the offset and size of its DEFLATE stream, its CRC32 and the size
+of the decompressed .DAT), so requests can select tiles, estimate sizes and
+splice tiles into bundles without probing the folder. It is refreshed
+incrementally: the folder is stat'ed at most every interval seconds, and
+only when its modification time changes is it rescanned, re-reading only
+the tiles which were added or changed. A tile looked up which isn't in the
+catalog is read on its own, without rescanning the folder. Tiles must be
+written by renaming them into place, so that the folder's modification time
+changes.
+'''
+
+import collections
+import os
+import re
+import threading
+import time
+
+from terrain_zip import read_gzip_member
+
+TileEntry = collections.namedtuple('TileEntry', ['size', 'mtime_ns', 'member'])
+
+TILE_RE = re.compile(r'^([NS])(\d{2})([EW])(\d{3})\.DAT\.gz$')
+
+# folder modification times this recent may not yet reflect every change
+RACY_NS = 2 * 1000 * 1000 * 1000
+
+
+def tile_position(name):
+    '''get the (lat_int, lon_int) of a tile name, or None if it isn't one'''
+    m = TILE_RE.match(name)
+    if m is None:
+        return None
+    lat = int(m.group(2)) * (-1 if m.group(1) == 'S' else 1)
+    lon = int(m.group(4)) * (-1 if m.group(3) == 'W' else 1)
+    if not (-90 <= lat < 90 and -180 <= lon < 180):
+        return None
+    return (lat, lon)
+
+
+class TileCatalog(object):
+    def __init__(self, folder, interval=10):
+        self.folder = folder
+        self.interval = interval
+        self.entries = {}
+        self.folder_mtime_ns = None
+        self.checked = None
+        self.lock = threading.Lock()
+
+    def refresh(self, force=False):
+        '''rescan the folder if it has changed since it was last scanned'''
+        now = time.monotonic()
+        with self.lock:
+            if not force and self.checked is not None and now - self.checked < self.interval:
+                return
+            self.checked = now
+            try:
+                st = os.stat(self.folder)
+            except FileNotFoundError:
+                self.clear()
+                return
+            if st.st_mtime_ns == self.folder_mtime_ns:
+                return
+            self.scan()
+            if time.time_ns() - st.st_mtime_ns < RACY_NS:
+                # changes made within the same timestamp could have been missed
+                self.folder_mtime_ns = None
+            else:
+                self.folder_mtime_ns = st.st_mtime_ns
+
+    def clear(self):
+        self.entries = {}
+        self.folder_mtime_ns = None
+
+    def scan(self):
+        '''re-read the tiles added or changed since the last scan'''
+        entries = {}
+        for entry in os.scandir(self.folder):
+            if tile_position(entry.name) is None:
+                continue
+            try:
+                st = entry.stat()
+                old = self.entries.get(entry.name)
+                if old is not None and (old.size, old.mtime_ns) == (st.st_size, st.st_mtime_ns):
+                    entries[entry.name] = old
+                else:
+                    entries[entry.name] = self.read(entry.path, st)
+            except (OSError, ValueError):
+                # removed, or not a complete gzip file
+                continue
+        # replaced whole, as lookups don't take the lock
+        self.entries = entries
+
+    def read(self, path, st):
+        with open(path, 'rb') as f:
+            return TileEntry(st.st_size, st.st_mtime_ns, read_gzip_member(f))
+
+    def update(self, name):
+        '''record a tile which has just been added or changed, returning its entry or None'''
+        path = os.path.join(self.folder, name)
+        try:
+            entry = self.read(path, os.stat(path))
+        except (OSError, ValueError):
+            entry = None
+        with self.lock:
+            if entry is None:
+                self.entries.pop(name, None)
+            else:
+                self.entries[name] = entry
+        return entry
+
+    def get(self, name):
+        '''get the entry of a tile, or None if the folder doesn't hold it'''
+        self.refresh()
+        entry = self.entries.get(name)
+        if entry is None and tile_position(name) is not None:
+            # it may have been added since the last refresh, which only
+            # needs that tile to be read rather than the folder rescanned
+            entry = self.update(name)
+        return entry
+
+    def __len__(self):
+        self.refresh()
+        return len(self.entries)
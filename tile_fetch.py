@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+'''
+Fetch .DAT.gz tiles from a terrain server into a local tile folder.
+
+The local folder acts as a persistent read-through cache of the server.
+Downloads run concurrently on a bounded pool, each thread reusing a
+keep-alive connection, and concurrent requests for the same tile share
+a single download.
+'''
+
+import concurrent.futures
+import http.client
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+
+
+class TileFetcher(object):
+    def __init__(self, url_path, tile_path, max_workers=4, timeout=60, metrics=None):
+        url = urllib.parse.urlsplit(url_path)
+        if url.scheme == 'https':
+            self.connection_class = http.client.HTTPSConnection
+        elif url.scheme == 'http':
+            self.connection_class = http.client.HTTPConnection
+        else:
+            raise ValueError("Unsupported terrain server URL %s" % url_path)
+        self.host = url.netloc
+        self.base = url.path if url.path.endswith('/') else url.path + '/'
+        self.tile_path = tile_path
+        self.timeout = timeout
+        self.metrics = metrics
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def path(self, name):
+        '''local path of a tile'''
+        return os.path.join(self.tile_path, name)
+
+    def fetch(self, name):
+        '''get a future for a tile being present in the local folder'''
+        with self.lock:
+            if name in self.inflight:
+                return self.inflight[name]
+            if os.path.exists(self.path(name)):
+                future = concurrent.futures.Future()
+                future.set_result(self.path(name))
+                return future
+            future = self.pool.submit(self.download, name)
+            self.inflight[name] = future
+        future.add_done_callback(lambda f: self.done(name))
+        return future
+
+    def fetch_many(self, names):
+        '''start fetching several tiles, returning their futures'''
+        return [self.fetch(name) for name in names]
+
+    def done(self, name):
+        with self.lock:
+            self.inflight.pop(name, None)
+
+    def connection(self):
+        '''get this thread's connection to the server'''
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = self.connection_class(self.host, timeout=self.timeout)
+        return self.local.connection
+
+    def request(self, name):
+        '''send a GET for a tile, retrying once if a kept-alive connection has closed'''
+        for attempt in range(2):
+            connection = self.connection()
+            try:
+                connection.request('GET', self.base + urllib.parse.quote(name))
+                return connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                self.local.connection = None
+                if attempt == 1:
+                    raise
+
+    def download(self, name):
+        '''download a tile, storing it atomically in the local folder'''
+        print("Downloading " + name)
+        start = time.monotonic()
+        response = self.request(name)
+        if response.status != 200:
+            response.read()
+            raise IOError("Failed to download %s: HTTP %u" % (name, response.status))
+        try:
+            os.makedirs(self.tile_path)
+        except OSError:
+            pass
+        tmp = self.path(name) + '.%u.%u.tmp' % (os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, 'wb') as f:
+                shutil.copyfileobj(response, f)
+            os.replace(tmp, self.path(name))
+        except:
+            self.local.connection.close()
+            self.local.connection = None
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        print("Downloaded " + name)
+        if self.metrics is not None:
+            self.metrics.observe('terraingen_download_seconds', time.monotonic() - start)
+            self.metrics.inc('terraingen_download_bytes_total', os.path.getsize(self.path(name)))
+        return self.path(name)
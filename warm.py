@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+'''
+Warm the app's caches with the most popular requests from its logs.
+
+The "Generate: lat lon radius version=" lines the app logs for each request
+are counted by the set of tiles they need, and the bundles for the most
+frequent sets are built ahead of the next request for them. Optionally the
+most popular tiles are also decompressed into the shared tile cache.
+
+Usage:
+    python3 warm.py <log> [<log> ...] [--top 50] [--min-count 2] [--tiles]
+'''
+
+import argparse
+import collections
+import gzip
+import os
+import re
+
+GENERATE_RE = re.compile(r'Generate: (-?[\d.]+) (-?[\d.]+) ([\d.]+) version=(\d+)')
+
+
+def read_requests(paths):
+    '''generate (lat, lon, radius, version) for each request in the logs'''
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', errors='replace') as f:
+            for line in f:
+                m = GENERATE_RE.search(line)
+                if m is not None:
+                    yield (float(m.group(1)), float(m.group(2)), int(float(m.group(3))), int(m.group(4)))
+
+
+def rank(requests):
+    '''count the requests for each set of tiles, returning a list of
+    (count, version, filelist) most popular first, and a Counter of
+    (version, tile) requests'''
+    import app as terrain_app
+    sets = collections.Counter()
+    tiles = collections.Counter()
+    for request in requests:
+        try:
+            (lat, lon, radius, version) = terrain_app.parseRequest(
+                dict(lat=request[0], long=request[1], radius=request[2], version=request[3]))
+        except:
+            continue
+        (filelist, outside) = terrain_app.getFileList(lat, lon, radius, version)
+        sets[(version, tuple(sorted(filelist)))] += 1
+        for fn in filelist:
+            tiles[(version, fn)] += 1
+    ranked = [(count, version, list(filelist)) for ((version, filelist), count) in sets.most_common()]
+    return (ranked, tiles)
+
+
+def warm(paths, top=50, min_count=2, tiles=False, dry_run=False):
+    '''build the bundles of the top most popular tile sets requested at least
+    min_count times, and decompress their tiles if tiles is set. Returns the
+    number of bundles built'''
+    import app as terrain_app
+    (ranked, tile_counts) = rank(read_requests(paths))
+    ranked = [r for r in ranked if r[0] >= min_count][:top]
+    built = 0
+    for (count, version, filelist) in ranked:
+        print("%u requests for %u tiles, version %u" % (count, len(filelist), version))
+        if dry_run:
+            continue
+        try:
+            if terrain_app.warmBundle(filelist, version):
+                built += 1
+        except Exception as ex:
+            print("Failed to warm bundle: {0}".format(ex))
+
+    if tiles and not dry_run:
+        wanted = set((version, fn) for (count, version, filelist) in ranked for fn in filelist)
+        for ((version, fn), count) in tile_counts.most_common():
+            if (version, fn) not in wanted:
+                continue
+            (tile_path, url_path) = terrain_app.getTilePath(version)
+            try:
+                terrain_app.readTile(fn, url_path)
+            except Exception as ex:
+                print("Failed to warm tile {0}: {1}".format(os.path.basename(fn), ex))
+    return built
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the most popular terrain bundles from request logs')
+    parser.add_argument('logs', nargs='+', help='App log files, optionally gzipped')
+    parser.add_argument('--top', type=int, default=50, help='Number of bundles to build (default: 50)')
+    parser.add_argument('--min-count', type=int, default=2,
+                        help='Only build bundles requested at least this many times (default: 2)')
+    parser.add_argument('--tiles', action='store_true',
+                        help='Also decompress the tiles of those bundles into the tile cache')
+    parser.add_argument('--dry-run', action='store_true', help='Only list the most popular bundles')
+    args = parser.parse_args()
+
+    built = warm(args.logs, args.top, args.min_count, args.tiles, args.dry_run)
+    print("Built %u bundles" % built)
+
+
+if __name__ == '__main__':
+    main()